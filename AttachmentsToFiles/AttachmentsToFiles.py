@@ -0,0 +1,194 @@
+'''----------------------------------------------------------------------------------
+ Tool Name:   Attachments To Files
+ Source Name: AttachmentsToFiles.py
+ Version:     ArcGIS 10.1
+ Required Arguments:
+              Input Dataset (Feature Class or Table)
+              Output Folder (Folder)
+ Optional Arguments:
+              Layout (String)
+              Manifest (File)
+              Skip Existing (Boolean)
+              Workers (Long)
+ Derived output:
+              Output Folder (Folder)
+
+ Description: Exports the geodatabase attachments of a dataset to files on disk.
+              The attachment table is read with a single cursor and the files are
+              written on a thread pool. A manifest CSV lists every attachment and
+              the file it was written to.
+----------------------------------------------------------------------------------'''
+
+# Import system modules
+import arcpy
+import io
+import os
+import re
+import sys
+import csv
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# The attachment helpers of the To Attachments tool, installed in the folder next to this one
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "ToAttachment"))
+from ToAttachments import attachmentKeys
+
+arcpy.env.overwriteOutput = True
+
+# Path of each file under the output folder. {oid} is the ObjectID of the feature,
+# {id} the ATTACHMENTID, {name} the attachment name and {bucket} the ObjectID // 1000
+DEFAULT_LAYOUT = "{oid}/{name}"
+# Number of files written at the same time
+WRITE_WORKERS = 8
+# Attachments read from the cursor but not yet written, per worker
+QUEUED_PER_WORKER = 4
+# Characters which cannot be used in a file name
+INVALID_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+# Failed attachments listed individually in the summary warning
+FAILURE_REPORT_LIMIT = 20
+
+
+def openManifest(path):
+    """Open the manifest CSV for writing under Python 2 or 3."""
+    if sys.version_info[0] < 3:
+        return open(path, 'wb')
+    return open(path, 'w', newline='')
+
+
+def safeName(name, attachmentID):
+    """Attachment names come from users; keep them out of other folders."""
+    name = INVALID_CHARS.sub("_", name or "").strip(" .")
+    return name or "attachment_{0}".format(attachmentID)
+
+
+def writeAttachment(task):
+    """Write one attachment to disk. Runs on a worker thread. Returns the
+    manifest row of the attachment, ending in its status: written, skipped or
+    the reason it failed."""
+    oid, attachmentID, name, contentType, data, path, skipExisting = task
+    size = len(data)
+    row = [oid, attachmentID, name, contentType, size, path]
+    try:
+        if skipExisting and os.path.isfile(path) and os.path.getsize(path) == size:
+            return row + ["skipped"]
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Another worker created it first
+                if not os.path.isdir(folder):
+                    raise
+        # Unbuffered, so the cursor's buffer goes straight to the operating system
+        with io.open(path, "wb", buffering=0) as f:
+            view = memoryview(data)
+            pos = 0
+            while pos < size:
+                pos += f.write(view[pos:])
+        return row + ["written"]
+    except Exception as e:
+        return row + ["failed: {0}".format(e)]
+
+
+def AttachmentsToFiles(in_dataset, outFolder, layout=DEFAULT_LAYOUT, manifest=None,
+                       skipExisting=True, workers=WRITE_WORKERS):
+    """Export the attachments of in_dataset to outFolder, one file per attachment
+    at the path given by layout, and list them in the manifest CSV."""
+    desc = arcpy.Describe(in_dataset)
+    attachTable = desc.catalogPath + "__ATTACH"
+    if not arcpy.Exists(attachTable):
+        arcpy.AddError("{0} does not have attachments.".format(in_dataset))
+        return
+
+    relField, keys = attachmentKeys(in_dataset, attachTable)
+    if keys is not None:
+        # Map each GlobalID back to its ObjectID
+        keys = dict((key, oid) for oid, key in keys.items())
+
+    if not os.path.isdir(outFolder):
+        os.makedirs(outFolder)
+    if not manifest:
+        manifest = os.path.join(outFolder, "manifest.csv")
+    count = int(arcpy.management.GetCount(attachTable).getOutput(0))
+    arcpy.SetProgressor("step", "Exporting attachments", 0, count, 1)
+
+    workers = max(1, int(workers))
+    # Bounds the BLOBs held in memory while they wait for a worker
+    slots = threading.Semaphore(workers * QUEUED_PER_WORKER)
+    done = deque()
+    failures = []
+    totals = {"written": 0, "skipped": 0}
+    used = set()
+
+    def finished(result):
+        # Runs on the pool's result thread; the main thread writes the manifest
+        done.append(result)
+        slots.release()
+
+    with openManifest(manifest) as f:
+        writer = csv.writer(f)
+        writer.writerow(["OID", "ATTACHMENTID", "ATT_NAME", "CONTENT_TYPE", "DATA_SIZE", "FILE", "STATUS"])
+
+        def drain():
+            while done:
+                row = done.popleft()
+                status = row[-1]
+                if status in totals:
+                    totals[status] += 1
+                else:
+                    failures.append((row[0], row[1], status))
+                writer.writerow(row)
+                arcpy.SetProgressorPosition()
+
+        pool = ThreadPool(workers)
+        try:
+            fields = [relField, "ATTACHMENTID", "ATT_NAME", "CONTENT_TYPE", "DATA"]
+            with arcpy.da.SearchCursor(attachTable, fields) as scur:
+                for key, attachmentID, name, contentType, data in scur:
+                    oid = keys.get(key) if keys is not None else key
+                    if oid is None or data is None:
+                        arcpy.AddWarning("Attachment {0} is not related to a record or has no data.".format(attachmentID))
+                        arcpy.SetProgressorPosition()
+                        continue
+                    name = safeName(name, attachmentID)
+                    path = os.path.normpath(os.path.join(outFolder, layout.format(
+                        oid=oid, id=attachmentID, name=name, bucket=oid // 1000)))
+                    # Two attachments of one record may share a name
+                    if path.lower() in used:
+                        root, ext = os.path.splitext(path)
+                        path = "{0}_{1}{2}".format(root, attachmentID, ext)
+                    used.add(path.lower())
+
+                    slots.acquire()
+                    pool.apply_async(writeAttachment,
+                                     ((oid, attachmentID, name, contentType, data, path, skipExisting),),
+                                     callback=finished)
+                    drain()
+        finally:
+            pool.close()
+            pool.join()
+        drain()
+
+    arcpy.AddMessage("{0} files written, {1} already existed.".format(totals["written"], totals["skipped"]))
+    if failures:
+        arcpy.AddWarning("{0} attachments could not be written.".format(len(failures)))
+        for oid, attachmentID, status in failures[:FAILURE_REPORT_LIMIT]:
+            arcpy.AddWarning("  OID {0}, attachment {1}: {2}".format(oid, attachmentID, status))
+        if len(failures) > FAILURE_REPORT_LIMIT:
+            arcpy.AddWarning("  ... and {0} more.".format(len(failures) - FAILURE_REPORT_LIMIT))
+
+
+# Run the script
+if __name__ == '__main__':
+    # Get Parameters
+    in_dataset = arcpy.GetParameterAsText(0)
+    outFolder = arcpy.GetParameterAsText(1)
+    layout = arcpy.GetParameterAsText(2) or DEFAULT_LAYOUT
+    manifest = arcpy.GetParameterAsText(3)
+    skipExisting = arcpy.GetParameter(4) if arcpy.GetArgumentCount() > 4 else True
+    workers = arcpy.GetParameter(5) if arcpy.GetArgumentCount() > 5 else None
+
+    AttachmentsToFiles(in_dataset, outFolder, layout, manifest, skipExisting, workers or WRITE_WORKERS)
+    arcpy.SetParameterAsText(6, outFolder)
+    print ("finished")
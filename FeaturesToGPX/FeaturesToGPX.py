@@ -13,6 +13,10 @@ Optional Arguements:
     Zero date (boolean): If no date exists, use this option to force dates to epcoh
         start, 1970-Jan-01. This will allow GPX files to open in Garmin Basecamp
     Pretty (boolean): Output gpx file will be "pretty", or easier to read.
+Python-only option (not in GPX.tbx; read from a fifth script argument if a
+matching parameter is added to a copy of the script tool):
+    append: Add the features to the end of an existing GPX file
+        instead of overwriting it.
 
 Description:
     This tool takes input features (layers or featureclass) with either point or
@@ -26,15 +30,22 @@ try:
 except:
     from xml.etree import ElementTree as ET
 import arcpy
+import os
+import sys
 import time
 import datetime
+import multiprocessing
 unicode = str
 
-gpx = ET.Element("gpx", xmlns="http://www.topografix.com/GPX/1/1",
-                 xalan="http://xml.apache.org/xalan",
-                 xsi="http://www.w3.org/2001/XMLSchema-instance",
-                 creator="Esri",
-                 version="1.1")
+
+def createGPX():
+    """Return a new, empty GPX root element.
+    """
+    return ET.Element("gpx", xmlns="http://www.topografix.com/GPX/1/1",
+                      xalan="http://xml.apache.org/xalan",
+                      xsi="http://www.w3.org/2001/XMLSchema-instance",
+                      creator="Esri",
+                      version="1.1")
 
 
 def prettify(elem):
@@ -46,8 +57,81 @@ def prettify(elem):
     return reparsed.toprettyxml(indent="  ")
 
 
+def _findClosingTag(gpxFile):
+    ''' Locate the end of the root element by reading only the tail of the file.
+        Returns (offset, selfClosing) where offset is the position of "</gpx>",
+        or of "/>" when the root element is empty, and None if neither is found.
+    '''
+
+    gpxFile.seek(0, os.SEEK_END)
+    size = gpxFile.tell()
+    start = max(0, size - 4096)
+    gpxFile.seek(start)
+    tail = gpxFile.read().rstrip()
+
+    if tail.endswith(b"</gpx>"):
+        return start + len(tail) - len(b"</gpx>"), False
+    if tail.endswith(b"/>") and tail[tail.rfind(b"<"):].startswith(b"<gpx"):
+        return start + len(tail[:-len(b"/>")].rstrip()), True
+    return None, False
+
+
+def _containsTag(gpxFile, tags, end, chunkSize=1024 * 1024):
+    ''' Scan the first end bytes of the file in chunks for any of the start tags
+        (such as b"<trk"). Stops at the first match; the file is only read.
+    '''
 
-def featuresToGPX(inputFC, outGPX, zerodate, pretty):
+    overlap = max(len(tag) for tag in tags) - 1
+    gpxFile.seek(0)
+    pos = 0
+    carry = b""
+    while pos < end:
+        chunk = gpxFile.read(min(chunkSize, end - pos))
+        if not chunk:
+            break
+        pos += len(chunk)
+        data = carry + chunk
+        if any(tag in data for tag in tags):
+            return True
+        carry = data[-overlap:]
+    return False
+
+
+def appendToGPX(gpx, outGPX, pretty=False):
+    ''' Stream the WPTs and TRKs of gpx into the existing outGPX, just before
+        its closing </gpx> tag. The cost is proportional to the new data; the
+        existing content of the file is not rewritten.
+
+        GPX 1.1 requires every WPT to come before the RTEs and TRKs, so appending
+        WPTs to a file which already has routes or tracks is refused; only then
+        is the existing content scanned for them.
+    '''
+
+    with open(outGPX, "r+b") as gpxFile:
+        offset, selfClosing = _findClosingTag(gpxFile)
+        if offset is None:
+            raise ValueError("{0} does not end with a closing </gpx> tag.".format(outGPX))
+        if any(elem.tag == "wpt" for elem in gpx) and _containsTag(gpxFile, (b"<trk", b"<rte"), offset):
+            raise ValueError("Cannot append waypoints to {0}, which already has tracks or routes: "
+                             "GPX 1.1 requires waypoints to come first. Write them to a new "
+                             "GPX file instead.".format(outGPX))
+
+        gpxFile.seek(offset)
+        if selfClosing:
+            gpxFile.write(b">\n" if pretty else b">")
+        for elem in gpx:
+            if pretty:
+                from xml.dom import minidom
+                child = minidom.parseString(ET.tostring(elem, 'utf-8')).documentElement
+                lines = child.toprettyxml(indent="  ").splitlines(True)
+                gpxFile.write("".join("  " + line for line in lines).encode("utf-8"))
+            else:
+                gpxFile.write(ET.tostring(elem, 'utf-8'))
+        gpxFile.write(b"</gpx>\n" if pretty else b"</gpx>")
+        gpxFile.truncate()
+
+
+def featuresToGPX(inputFC, outGPX, zerodate, pretty, append=False):
     ''' This is called by the __main__ if run from a tool or at the command line
     '''
 
@@ -56,142 +140,176 @@ def featuresToGPX(inputFC, outGPX, zerodate, pretty):
         arcpy.AddWarning("Input data is not projected in WGS84,"
                          " features were reprojected on the fly to create the GPX.")
 
-    generatePointsFromFeatures(inputFC , descInput, zerodate)
+    gpx = generatePointsFromFeatures(inputFC, descInput, zerodate, createGPX())
+    writeGPX(gpx, outGPX, pretty, append)
+
+
+def writeGPX(gpx, outGPX, pretty=False, append=False):
+    ''' Write the output GPX file '''
 
-    # Write the output GPX file
     try:
-        if pretty:
-            gpxFile = open(outGPX, "w")
-            gpxFile.write(prettify(gpx))
+        if append and os.path.exists(outGPX):
+            appendToGPX(gpx, outGPX, pretty)
+        elif pretty:
+            with open(outGPX, "w") as gpxFile:
+                gpxFile.write(prettify(gpx))
         else:
-            gpxFile = open(outGPX, "wb")
-            ET.ElementTree(gpx).write(gpxFile, encoding="UTF-8", xml_declaration=True)
+            with open(outGPX, "wb") as gpxFile:
+                ET.ElementTree(gpx).write(gpxFile, encoding="UTF-8", xml_declaration=True)
     except TypeError as e:
         arcpy.AddError("Error serializing GPX into the file.")
-    finally:
-        gpxFile.close()
+        # Re-raise so the tool fails and featuresToGPXBatch reports the pair,
+        # as messages added in a worker process are not seen by the caller
+        raise
+    except ValueError as e:
+        # The existing file cannot be appended to
+        arcpy.AddError(str(e))
+        raise
 
 
+def _convertPair(args):
+    ''' Pool worker for featuresToGPXBatch. Returns (inputFC, outGPX, error) '''
 
-def generatePointsFromFeatures(inputFC, descInput, zerodate=False):
+    inputFC, outGPX, zerodate, pretty, append = args
+    try:
+        featuresToGPX(inputFC, outGPX, zerodate, pretty, append)
+        return inputFC, outGPX, None
+    except Exception as e:
+        return inputFC, outGPX, str(e)
 
-    def attHelper(row):
-        # helper function to get/set field attributes for output gpx file
 
-        pnt = row[1].getPart()
-        valuesDict["PNTX"] = str(pnt.X)
-        valuesDict["PNTY"] = str(pnt.Y)
+def featuresToGPXBatch(pairs, zerodate=False, pretty=False, workers=None, append=False):
+    ''' Convert a list of (inputFC, outGPX) pairs across a process pool.
 
-        Z = pnt.Z if descInput.hasZ else None
-        if Z or ("ELEVATION" in cursorFields):
-            valuesDict["ELEVATION"] = str(Z) if Z else str(row[fieldNameDict["ELEVATION"]])
-        else:
-            valuesDict["ELEVATION"] = str(0)
+        Every conversion builds its own GPX document, so outputs never share
+        state. Each worker process imports arcpy once and is reused for many
+        conversions. Returns a list of (inputFC, outGPX, error) tuples where
+        error is None for a successful conversion.
+    '''
 
-        valuesDict["NAME"] = row[fieldNameDict["NAME"]] if "NAME" in fields else " "
-        valuesDict["DESCRIPT"] = row[fieldNameDict["DESCRIPT"]] if "DESCRIPT" in fields else " "
+    tasks = [(inputFC, outGPX, zerodate, pretty, append) for inputFC, outGPX in pairs]
+    if not tasks:
+        return []
 
+    # Inside ArcMap / ArcGIS Pro sys.executable is the application, not python
+    if not os.path.basename(sys.executable).lower().startswith("python"):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
 
-        if "DATETIMES" in fields:
-            row_time = row[fieldNameDict["DATETIMES"]]
-            formatted_time = row_time if row_time else " "
-        elif zerodate and "DATETIMES" not in fields:
-            formatted_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(0))
-        else:
-            formatted_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(0)) if zerodate else " "
-
-        valuesDict["DATETIMES"] = formatted_time
-
-        return
-    #-------------end helper function-----------------
-
-
-    def getValuesFromFC(inputFC, cursorFields ):
-
-        previousPartNum = 0
-        startTrack = True
-
-        # Loop through all features and parts
-        with arcpy.da.SearchCursor(inputFC, cursorFields, spatial_reference="4326", explode_to_points=True) as searchCur:
-            for row in searchCur:
-                if descInput.shapeType == "Polyline":
-                    for part in row:
-                        try:
-                            newPart = False
-                            if not row[0] == previousPartNum or startTrack is True:
-                                startTrack = False
-                                newPart = True
-                            previousPartNum = row[0]
-    
-                            attHelper(row)
-                            yield "trk", newPart
-                        except:
-                            arcpy.AddWarning("Problem reading values for row: {}. Skipping.".format(row[0]))
-
-                elif descInput.shapeType == "Multipoint" or descInput.shapeType == "Point":
-                    # check to see if data was original GPX with "Type" of "TRKPT" or "WPT"
-                    trkType = row[fieldNameDict["TYPE"]].upper() if "TYPE" in fields else None
-                    try:
-                        attHelper(row)
-    
-                        if trkType == "TRKPT":
-                            newPart = False
-                            if previousPartNum == 0:
-                                newPart = True
-                                previousPartNum = 1
-    
-                            yield "trk", newPart
-    
-                        else:
-                            yield "wpt", None
-                    except:
-                        arcpy.AddWarning("Problem reading values for row: {}. Skipping.".format(row[0]))
-                        
-    # ---------end get values function-------------
-
-
-    # Get list of available fields
-    fields = [f.name.upper() for f in arcpy.ListFields(inputFC)]
-    valuesDict = {"ELEVATION": 0, "NAME": "", "DESCRIPT": "", "DATETIMES": "", "TYPE": "", "PNTX": 0, "PNTY": 0}
-    fieldNameDict = {"ELEVATION": 0, "NAME": 1, "DESCRIPT": 2, "DATETIMES": 3, "TYPE": 4, "PNTX": 5, "PNTY": 6}
-
-    cursorFields = ["OID@", "SHAPE@"]
-
-    for key, item in valuesDict.items():
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = []
+        for result in pool.imap_unordered(_convertPair, tasks):
+            if result[2]:
+                arcpy.AddWarning("Could not convert {0}: {1}".format(result[0], result[2]))
+            results.append(result)
+        return results
+    finally:
+        pool.close()
+        pool.join()
+
+
+def compileRowProjector(fields, hasZ, zerodate=False):
+    ''' Resolve the known GPX schema against the input fields once.
+
+        Returns the cursor fields to read, the index of the TYPE field (or None)
+        and a projector which maps a cursor row straight to an output record of
+        (lon, lat, ele, time, name, desc).
+    '''
+
+    cursorFields = ["OID@", "SHAPE@XY"]
+    if hasZ:
+        cursorFields.append("SHAPE@Z")
+    for key in ("ELEVATION", "NAME", "DESCRIPT", "DATETIMES", "TYPE"):
         if key in fields:
-            fieldNameDict[key] = len(cursorFields)  # assign current index
-            cursorFields.append(key)   # build up list of fields for cursor
+            cursorFields.append(key)
+
+    zIdx = cursorFields.index("SHAPE@Z") if hasZ else None
+    eleIdx = cursorFields.index("ELEVATION") if "ELEVATION" in cursorFields else None
+    nameIdx = cursorFields.index("NAME") if "NAME" in cursorFields else None
+    descIdx = cursorFields.index("DESCRIPT") if "DESCRIPT" in cursorFields else None
+    timeIdx = cursorFields.index("DATETIMES") if "DATETIMES" in cursorFields else None
+    typeIdx = cursorFields.index("TYPE") if "TYPE" in cursorFields else None
+
+    # Values which do not depend on the row are resolved here, not per point
+    noTime = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(0)) if zerodate else " "
+    noEle = str(0)
+
+    def project(row):
+        x, y = row[1]
+        Z = row[zIdx] if zIdx is not None else None
+        if Z:
+            ele = str(Z)
+        elif eleIdx is not None:
+            ele = str(row[eleIdx])
+        else:
+            ele = noEle
+        if timeIdx is not None:
+            formatted_time = row[timeIdx] or " "
         else:
-            fieldNameDict[key] = None
-
-    for index, gpxValues in enumerate(getValuesFromFC(inputFC, cursorFields)):
-
-        if gpxValues[0] == "wpt":
-            wpt = ET.SubElement(gpx, 'wpt', {'lon':valuesDict["PNTX"], 'lat':valuesDict["PNTY"]})
-            wptEle = ET.SubElement(wpt, "ele")
-            wptEle.text = valuesDict["ELEVATION"]
-            wptTime = ET.SubElement(wpt, "time")
-            wptTime.text = valuesDict["DATETIMES"]
-            wptName = ET.SubElement(wpt, "name")
-            wptName.text = valuesDict["NAME"]
-            wptDesc = ET.SubElement(wpt, "desc")
-            wptDesc.text = valuesDict["DESCRIPT"]
-
-        else:  #TRKS
-            if gpxValues[1]:
-                # Elements for the start of a new track
-                trk = ET.SubElement(gpx, "trk")
-                trkName = ET.SubElement(trk, "name")
-                trkName.text = valuesDict["NAME"]
-                trkDesc = ET.SubElement(trk, "desc")
-                trkDesc.text = valuesDict["DESCRIPT"]
-                trkSeg = ET.SubElement(trk, "trkseg")
-
-            trkPt = ET.SubElement(trkSeg, "trkpt", {'lon':valuesDict["PNTX"], 'lat':valuesDict["PNTY"]})
-            trkPtEle = ET.SubElement(trkPt, "ele")
-            trkPtEle.text = valuesDict["ELEVATION"]
-            trkPtTime = ET.SubElement(trkPt, "time")
-            trkPtTime.text = valuesDict["DATETIMES"]
+            formatted_time = noTime
+        return (str(x), str(y), ele, formatted_time,
+                row[nameIdx] if nameIdx is not None else " ",
+                row[descIdx] if descIdx is not None else " ")
+
+    return cursorFields, typeIdx, project
+
+
+def generatePointsFromFeatures(inputFC, descInput, zerodate=False, gpx=None):
+    ''' Add the WPTs and TRKs for inputFC to gpx (a new document if not given)
+        and return it.
+    '''
+
+    if gpx is None:
+        gpx = createGPX()
+
+    shapeType = descInput.shapeType
+    if shapeType not in ("Polyline", "Multipoint", "Point"):
+        return gpx
+
+    # Get list of available fields and compile the row projector for this schema
+    fields = set(f.name.upper() for f in arcpy.ListFields(inputFC))
+    cursorFields, typeIdx, project = compileRowProjector(fields, descInput.hasZ, zerodate)
+    isLine = shapeType == "Polyline"
+
+    SubElement = ET.SubElement
+    previousOID = None
+    trkSeg = None
+
+    # Loop through all features and parts
+    with arcpy.da.SearchCursor(inputFC, cursorFields, spatial_reference="4326", explode_to_points=True) as searchCur:
+        for row in searchCur:
+            try:
+                lon, lat, ele, formatted_time, name, desc = project(row)
+
+                if isLine:
+                    newPart = trkSeg is None or row[0] != previousOID
+                    previousOID = row[0]
+                # check to see if data was original GPX with "Type" of "TRKPT" or "WPT"
+                elif typeIdx is not None and (row[typeIdx] or "").upper() == "TRKPT":
+                    newPart = trkSeg is None
+                else:
+                    wpt = SubElement(gpx, 'wpt', {'lon': lon, 'lat': lat})
+                    SubElement(wpt, "ele").text = ele
+                    SubElement(wpt, "time").text = formatted_time
+                    SubElement(wpt, "name").text = name
+                    SubElement(wpt, "desc").text = desc
+                    continue
+
+                if newPart:
+                    # Elements for the start of a new track
+                    trk = SubElement(gpx, "trk")
+                    SubElement(trk, "name").text = name
+                    SubElement(trk, "desc").text = desc
+                    trkSeg = SubElement(trk, "trkseg")
+
+                trkPt = SubElement(trkSeg, "trkpt", {'lon': lon, 'lat': lat})
+                SubElement(trkPt, "ele").text = ele
+                SubElement(trkPt, "time").text = formatted_time
+            except:
+                arcpy.AddWarning("Problem reading values for row: {}. Skipping.".format(row[0]))
+
+    return gpx
 
 
 
@@ -203,4 +321,5 @@ if __name__ == "__main__":
     outGPX = arcpy.GetParameterAsText(1)
     zerodate = arcpy.GetParameter(2)
     pretty = arcpy.GetParameter(3)
-    featuresToGPX(inputFC, outGPX, zerodate, pretty)
+    append = arcpy.GetParameter(4) if arcpy.GetArgumentCount() > 4 else False
+    featuresToGPX(inputFC, outGPX, zerodate, pretty, append)
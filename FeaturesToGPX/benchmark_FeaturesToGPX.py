@@ -0,0 +1,178 @@
+'''
+Source Name: benchmark_FeaturesToGPX.py
+Version: Python 2.7 / 3.4+ (ArcGIS is not required)
+
+Description:
+    Benchmarks the exporter in FeaturesToGPX.py without ArcGIS. A stand-in arcpy
+    module is installed whose SearchCursor yields synthetic rows, so
+    generatePointsFromFeatures and the GPX serializer run exactly as they do in
+    the tool. Each scenario runs in its own process and reports:
+
+        points/s   rows converted to GPX elements per second
+        MB/s       GPX megabytes written per second by the compact or pretty path
+        peak RSS   peak resident memory of the process (Linux / macOS only)
+
+    Scenarios cover waypoints (Point), tracks (Polyline) and TRKPT typed points,
+    each with and without the GPX attribute fields.
+
+    peakRSS and runIsolated are also used by benchmark_ToAttachments.py.
+
+Usage:
+    python benchmark_FeaturesToGPX.py
+    python benchmark_FeaturesToGPX.py --points 5000000 --paths compact
+    python benchmark_FeaturesToGPX.py --scenarios tracks,tracks-bare --track-length 5000
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import types
+
+SCENARIOS = {
+    # name: (shape type, attribute fields, TYPE value)
+    "waypoints":       ("Point",    ["NAME", "DESCRIPT", "DATETIMES", "ELEVATION"], None),
+    "waypoints-bare":  ("Point",    [], None),
+    "tracks":          ("Polyline", ["NAME", "DESCRIPT", "DATETIMES", "ELEVATION"], None),
+    "tracks-bare":     ("Polyline", [], None),
+    "trkpts":          ("Point",    ["NAME", "DESCRIPT", "DATETIMES", "ELEVATION", "TYPE"], "TRKPT"),
+}
+
+
+def installFakeArcpy(points, fields, trackLength, typeValue):
+    ''' Put a stand-in arcpy module in sys.modules which serves synthetic rows '''
+
+    class Field(object):
+        def __init__(self, name):
+            self.name = name
+
+    class SearchCursor(object):
+        def __init__(self, inputFC, cursorFields, **kwargs):
+            self.cursorFields = cursorFields
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def __iter__(self):
+            values = {"NAME": "Track name", "DESCRIPT": "Synthetic feature",
+                      "DATETIMES": "2016-08-24T12:00:00Z", "ELEVATION": 123.5,
+                      "TYPE": typeValue}
+            getters = []
+            for name in self.cursorFields:
+                if name == "OID@":
+                    getters.append(lambda i: i // trackLength + 1)
+                elif name == "SHAPE@XY":
+                    getters.append(lambda i: (-120.0 + i * 1e-6, 35.0 + i * 1e-6))
+                elif name == "SHAPE@Z":
+                    getters.append(lambda i: 100.0 + i % 50)
+                else:
+                    getters.append(lambda i, v=values[name]: v)
+            for i in range(points):
+                yield tuple([get(i) for get in getters])
+
+    arcpy = types.ModuleType("arcpy")
+    arcpy.da = types.ModuleType("arcpy.da")
+    arcpy.da.SearchCursor = SearchCursor
+    arcpy.ListFields = lambda inputFC: [Field(name) for name in fields]
+    arcpy.AddWarning = arcpy.AddError = arcpy.AddMessage = lambda message: sys.stderr.write(message + "\n")
+    arcpy.GetArgumentCount = lambda: 0
+    sys.modules["arcpy"] = arcpy
+    sys.modules["arcpy.da"] = arcpy.da
+
+
+def peakRSS():
+    ''' Peak resident set size of this process in MB, or None if unavailable '''
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def _putResult(queue, target, *args):
+    queue.put(target(*args))
+
+
+def runIsolated(target, *args):
+    ''' Run target(*args) in a fresh process, so peak RSS belongs to that run alone
+        and any stand-in modules it installs do not leak into the next run.
+        Returns the result of target, or None if the process failed.
+
+        A plain Process rather than a Pool, as Pool workers cannot start the
+        process pools of the code being measured.
+    '''
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_putResult, args=(queue, target) + args)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return None
+    return queue.get()
+
+
+def runScenario(args):
+    ''' Convert one scenario and write it with one path; runs in a fresh process '''
+
+    name, path, points, trackLength, outDir = args
+    shapeType, fields, typeValue = SCENARIOS[name]
+    installFakeArcpy(points, fields, trackLength, typeValue)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import FeaturesToGPX
+
+    class Describe(object):
+        hasZ = True
+    descInput = Describe()
+    descInput.shapeType = shapeType
+
+    start = time.time()
+    gpx = FeaturesToGPX.generatePointsFromFeatures("synthetic", descInput, zerodate=True)
+    generateTime = time.time() - start
+
+    outGPX = os.path.join(outDir, "{0}_{1}.gpx".format(name, path))
+    start = time.time()
+    FeaturesToGPX.writeGPX(gpx, outGPX, pretty=(path == "pretty"))
+    writeTime = time.time() - start
+    size = os.path.getsize(outGPX)
+    os.remove(outGPX)
+
+    return name, path, points / generateTime, size / writeTime, size, peakRSS()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FeaturesToGPX exporter with a synthetic cursor.")
+    parser.add_argument("--points", type=int, default=1000000, help="rows served by the cursor per scenario")
+    parser.add_argument("--track-length", type=int, default=1000, help="points per track for Polyline scenarios")
+    parser.add_argument("--scenarios", default=",".join(sorted(SCENARIOS)), help="comma separated scenario names")
+    parser.add_argument("--paths", default="compact,pretty", help="comma separated serializer paths")
+    args = parser.parse_args()
+
+    outDir = tempfile.mkdtemp(prefix="gpxbench_")
+    print("{0:<16}{1:<9}{2:>14}{3:>14}{4:>12}{5:>12}".format(
+        "scenario", "path", "points/s", "MB/s", "output MB", "peak RSS MB"))
+    try:
+        for name in args.scenarios.split(","):
+            for path in args.paths.split(","):
+                result = runIsolated(runScenario, (name, path, args.points, args.track_length, outDir))
+                if result is None:
+                    print("{0:<16}{1:<9} failed".format(name, path))
+                    continue
+                name, path, pointRate, byteRate, size, rss = result
+                print("{0:<16}{1:<9}{2:>14,.0f}{3:>14.1f}{4:>12.1f}{5:>12}".format(
+                    name, path, pointRate, byteRate / 1048576.0, size / 1048576.0,
+                    "n/a" if rss is None else "{0:.0f}".format(rss)))
+    finally:
+        os.rmdir(outDir)
+
+
+if __name__ == "__main__":
+    main()
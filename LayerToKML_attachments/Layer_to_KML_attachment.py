@@ -10,7 +10,7 @@
 # Optional Arguments:
 #    Output scale (long): scale to create output KMZ file
 #    Clamped to ground (boolean): Clamp features to the ground (override their elevation)
-#    Allow Unique ID Field (boolean): allow a temporary ID field to be added to the input data
+#    Allow Unique ID Field (boolean): no longer used, the input data is never edited
 #    Height (long): set the height to display image attachments in the KML popup
 #    Width (long): set the width to display image attachments in the KML popup
 # ==================================================================================================
@@ -18,13 +18,20 @@
 import arcpy
 import os
 import sys
+import hashlib
 import zipfile
-import shutil
+import tempfile
+import threading
+from xml.sax.saxutils import escape, quoteattr
 from distutils.version import StrictVersion
 try:
   from xml.etree import cElementTree as ElementTree
 except:
   from xml.etree import ElementTree
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 # These "supported" items determine what HTML to put into the HTML popup.
 # If this list is enhanced, the IFSTATEMENT writing HTML needs to be updated.
@@ -32,6 +39,71 @@ fileTypes = {'IMG' : ['.jpg', '.png', '.gif'],
              'PDF' : ['.pdf']
              }
 
+KML_NAMESPACE = "http://www.opengis.net/kml/2.2"
+KML_NS = ".//{" + KML_NAMESPACE + "}"
+PLACEMARK = "{" + KML_NAMESPACE + "}Placemark"
+ElementTree.register_namespace('', KML_NAMESPACE)
+ElementTree.register_namespace('gx', "http://www.google.com/kml/ext/2.2")
+
+# Files which are already compressed are stored in the KMZ as they are, deflating them only costs time
+STORED_TYPES = ('.jpg', '.jpeg', '.png', '.gif', '.pdf', '.zip', '.kmz', '.gz', '.7z',
+                '.mp3', '.mp4', '.m4a', '.mov', '.avi', '.wmv', '.docx', '.xlsx', '.pptx')
+# Bytes of doc.kml handed to the background writer (which deflates them) at a time
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def compression(fileName):
+  """ The zip compression to use for a file in the KMZ """
+
+  if os.path.splitext(fileName)[1].lower() in STORED_TYPES:
+    return zipfile.ZIP_STORED
+  return zipfile.ZIP_DEFLATED
+
+
+class BackgroundWriter(object):
+  """ File object which writes to another file object on a worker thread. zlib releases the GIL
+      while it compresses, so a KMZ entry is deflated while the next part of it is being produced """
+
+  def __init__(self, out):
+    self.out = out
+    self.buffer = []
+    self.size = 0
+    self.error = None
+    self.chunks = queue.Queue(4)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    while True:
+      chunk = self.chunks.get()
+      if chunk is None:
+        return
+      if self.error is None:
+        try:
+          self.out.write(chunk)
+        except Exception as e:
+          self.error = e
+
+  def write(self, data):
+    self.buffer.append(data)
+    self.size += len(data)
+    if self.size >= WRITE_BUFFER_SIZE:
+      self.flush()
+
+  def flush(self):
+    if self.buffer:
+      self.chunks.put(b''.join(self.buffer))
+      self.buffer = []
+      self.size = 0
+
+  def close(self):
+    self.flush()
+    self.chunks.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
 
 def checks(inputFeatures):
   """ Pre checks to make sure we can run """
@@ -67,90 +139,178 @@ def checks(inputFeatures):
   ## find the attachment table
   attachTable = hasAttachments(inputFeatures)
 
-  ## check for sequential OIDs
-  seq = True
-  if max([row[0] for row in arcpy.da.SearchCursor(inputFeatures,["OID@"])]) != \
-     int(arcpy.GetCount_management(inputFeatures).getOutput(0)):
-    seq = False
-
-  return attachTable, seq
-
-
-def attachments(KMLfiles, KMLdir, attachTable, seq=True, uniqueID=False, height=None, width=None):
-  """ Take attachments, extract to disk, update the KML and put them into the KMZ """
+  ## read the OIDs in the order Layer To KML writes the placemarks, ID_0 is the first feature
+  with arcpy.da.SearchCursor(inputFeatures, ["OID@"]) as cursor:
+    oids = [row[0] for row in cursor]
 
-  docKML = os.path.join(KMLdir, "doc.kml")
-  ElementTree.register_namespace('', "http://www.opengis.net/kml/2.2")
-  tree = ElementTree.parse(docKML)
+  return attachTable, oids
 
-  KML_NS = ".//{http://www.opengis.net/kml/2.2}"
-  for node in tree.findall(KML_NS + 'Placemark'):
-    idTxt = node.attrib['id']
-    idVal = int(idTxt.replace('ID_', '')) + 1 # add 1 because its 0 indexed.
-    for node in node.findall(KML_NS + 'description') :
-      html = node.text
 
-      # Special handling for the addition of the tempID field
-      if not seq and uniqueID:
-        gidTD = html.find("tempIDField")
-        gidStart = html.find("<td>", gidTD)
-        GID = html[gidStart+4 : gidStart+20]
+def indexAttachments(attachTable, kmz, oids):
+  """ Read the attachment table once, writing the attachments of the features in oids (the features
+      Layer To KML wrote, honouring any selection or definition query) into the files folder of the KMZ.
+      Files are named by a hash of their content, so identical attachments are stored once.
+      Returns a dictionary of REL_OBJECTID to the (file name, attachment name) pairs of that feature """
 
-        # Remove the GUID field from the HTML.
-        html = html[:gidTD-4] + html[gidStart+25:]
-
-        # Take guid and match it to find the OID to use in the attachment table
-        expression = "tempIDField = '{0}'".format(GID)
-        with arcpy.da.SearchCursor(inputFeatures, ['OID@','tempIDField'], expression) as cursor:
-          for row in cursor:
-            tableMatchOID = row[0]
-
-      # Extract the images and add HTML into the KML
+  index = {}
+  written = set(kmz.namelist())
+  with arcpy.da.SearchCursor(attachTable, ['DATA', 'ATT_NAME', 'REL_OBJECTID'],
+                             sql_clause=(None, "ORDER BY REL_OBJECTID")) as cursor:
+    for row in cursor:
+      if row[2] not in oids:
+        continue
       try:
-        string2Inject = ''
-        if not seq and uniqueID: # Use the field that was inserted
-          exp = "REL_OBJECTID = {0}".format(tableMatchOID)
-        else: # Otherwise, use the ID value from KML to match
-          exp = "REL_OBJECTID = {0}".format(idVal)
-
-        with arcpy.da.SearchCursor(attachTable,['DATA', 'ATT_NAME', 'REL_OBJECTID'], exp) as cursor:
-          for row in cursor:
-            binaryRep = row[0]
-            fileName = row[1]
-            # save to disk
-            open(os.path.join(KMLfiles, fileName), 'wb').write(binaryRep.tobytes())
-            fname, ext = os.path.splitext(fileName)
-
-            os.rename(os.path.join(KMLfiles, fileName), os.path.join(KMLfiles, fileName.lower()))
-            fileName = fileName.lower()
-
-            filetype = "unknown"
-            for k, v in fileTypes.items():
-              if ext.lower() in v:
-                filetype = k
-
-            # Add new items here if the 'fileTypes' dictionary has been updated.
-            if filetype == 'IMG':
-              if height or width:
-                string2Inject += " <br> <img src=\"files\{0}\" height={1} width={2}> ".format( fileName, height, width )
-              else:
-                string2Inject += " <br> <img src=\"files\{0}\"> ".format( fileName )
-            elif filetype == 'PDF':
-              string2Inject += " <br> <a href =\"files\{0}\">PDF: {1} </a> ".format(fileName, fileName)
-            else:  # unknown
-              arcpy.AddWarning("Unknown or unsupported file type for OBJECTID: {}.".format(row[2]))
-              arcpy.AddWarning("{}  will not be accessible in the popup.".format(fileName))
-
-            string2Inject += '</td>'
-            newHTML = html.replace("</td>", string2Inject, 1)
-            node.text = newHTML
-
+        binaryRep = row[0]
+        fileName = hashlib.sha1(binaryRep).hexdigest() + os.path.splitext(row[1])[1].lower()
+        if "files/" + fileName not in written:
+          # Python 3 zips the cursor's buffer as it is, Python 2 needs a string
+          if sys.version_info[0] < 3:
+            binaryRep = binaryRep.tobytes()
+          kmz.writestr("files/" + fileName, binaryRep, compression(fileName))
+          written.add("files/" + fileName)
+        index.setdefault(row[2], []).append((fileName, row[1]))
       except:
-        arcpy.AddWarning("No attachment match for ID: {}".format(idVal))
-
-  tree.write(docKML)
-  del tree
-  del docKML
+        arcpy.AddWarning("Attachment {0} of OBJECTID: {1} has no data or name and was skipped.".format(row[1], row[2]))
+
+  return index
+
+
+def describePlacemark(placemark, index, oids, height=None, width=None):
+  """ Update the description of a placemark to show the attachments of its feature """
+
+  idTxt = placemark.attrib['id']
+  idVal = int(idTxt.replace('ID_', '')) # 0 indexed position of the feature in oids
+  for node in placemark.findall(KML_NS + 'description') :
+    html = node.text
+
+    # Add HTML for the feature's attachments into the KML
+    try:
+      string2Inject = ''
+      matchOID = oids[idVal]
+
+      for fileName, attachmentName in index.get(matchOID, []):
+        fname, ext = os.path.splitext(fileName)
+
+        filetype = "unknown"
+        for k, v in fileTypes.items():
+          if ext.lower() in v:
+            filetype = k
+
+        # Add new items here if the 'fileTypes' dictionary has been updated.
+        if filetype == 'IMG':
+          if height or width:
+            string2Inject += " <br> <img src=\"files\{0}\" height={1} width={2}> ".format( fileName, height, width )
+          else:
+            string2Inject += " <br> <img src=\"files\{0}\"> ".format( fileName )
+        elif filetype == 'PDF':
+          string2Inject += " <br> <a href =\"files\{0}\">PDF: {1} </a> ".format(fileName, attachmentName)
+        else:  # unknown
+          arcpy.AddWarning("Unknown or unsupported file type for OBJECTID: {}.".format(matchOID))
+          arcpy.AddWarning("{}  will not be accessible in the popup.".format(attachmentName))
+
+      string2Inject += '</td>'
+      node.text = html.replace("</td>", string2Inject, 1)
+
+    except:
+      arcpy.AddWarning("No attachment match for ID: {}".format(idVal))
+
+
+def startTag(element, root=False):
+  """ The start tag and text of an element whose children are written separately """
+
+  attributes = ''.join(' {0}={1}'.format(k.split('}')[-1], quoteattr(v)) for k, v in element.attrib.items())
+  if root:
+    attributes = ' xmlns="{0}"'.format(KML_NAMESPACE) + attributes
+  return "<{0}{1}>{2}".format(element.tag.split('}')[-1], attributes, escape(element.text or ''))
+
+
+def serialize(element):
+  """ An element and its children as KML, relying on the root element to declare the KML namespace """
+
+  return ElementTree.tostring(element).replace(b' xmlns="' + KML_NAMESPACE.encode("ascii") + b'"', b'', 1)
+
+
+def rewriteKML(docKML, out, rewrite):
+  """ Copy the KML in docKML to the file object out one placemark at a time, calling rewrite on
+      each placemark before it is written. Only the placemark being rewritten is held in memory.
+      The output is written (and deflated) on a background thread while the next placemarks are parsed """
+
+  out = BackgroundWriter(out)
+  try:
+    streamKML(docKML, out, rewrite)
+  finally:
+    out.close()
+
+
+def streamKML(docKML, out, rewrite):
+  """ Parse docKML and write it to out, see rewriteKML """
+
+  def write(text):
+    if not isinstance(text, bytes):
+      text = text.encode("ascii", "xmlcharrefreplace")
+    out.write(text)
+
+  path = []   # the elements from the root to the one being parsed
+  opened = 0  # the number of elements in path whose start tag has been written
+  for event, element in ElementTree.iterparse(docKML, events=("start", "end")):
+    if event == "start":
+      path.append(element)
+      if element.tag == PLACEMARK:
+        # Write everything before the placemark: the start of its containers and their earlier children.
+        # The parser reads ahead, so containers may already hold elements which come after the placemark
+        for depth, container in enumerate(path[:-1]):
+          if depth >= opened:
+            write(startTag(container, depth == 0))
+          for child in list(container):
+            if child is path[depth + 1]:
+              break
+            write(serialize(child))
+            container.remove(child)
+        opened = len(path) - 1
+
+    else:
+      path.pop()
+      if element.tag == PLACEMARK:
+        rewrite(element)
+        element.tail = None
+        write(serialize(element))
+        path[-1].remove(element)
+      elif len(path) < opened:
+        # A container whose start tag was written: finish it
+        for child in list(element):
+          write(serialize(child))
+        write("</{0}>".format(element.tag.split('}')[-1]))
+        opened = len(path)
+        if path:
+          path[-1].remove(element)
+      elif not path:
+        # No placemarks at all
+        write(serialize(element))
+
+
+def attachments(source, kmz, attachTable, oids, height=None, width=None):
+  """ Put the attachments into the new KMZ and write doc.kml from the source KMZ into it,
+      updated to show them. oids lists the OID of each placemark in order """
+
+  index = indexAttachments(attachTable, kmz, set(oids))
+
+  def rewrite(placemark):
+    describePlacemark(placemark, index, oids, height, width)
+
+  with source.open("doc.kml") as docKML:
+    if sys.version_info >= (3, 6):
+      # Stream doc.kml straight into the KMZ
+      with kmz.open("doc.kml", "w", force_zip64=True) as out:
+        rewriteKML(docKML, out, rewrite)
+    else:
+      # Older zipfile modules can only add a whole file, so stream it to a temporary file first
+      tempKML = tempfile.NamedTemporaryFile(suffix=".kml", delete=False)
+      try:
+        with tempKML:
+          rewriteKML(docKML, tempKML, rewrite)
+        kmz.write(tempKML.name, "doc.kml")
+      finally:
+        os.remove(tempKML.name)
 
 
 if __name__ == '__main__':
@@ -169,82 +329,39 @@ if __name__ == '__main__':
   outputKML = arcpy.GetParameterAsText(1)
   outputScale = arcpy.GetParameterAsText(2)
   clamped = arcpy.GetParameterAsText(3)
-  uniqueID = arcpy.GetParameterAsText(4)
+  # Parameter 4 (Allow Unique ID Field) is no longer needed, the input is never edited
   height = arcpy.GetParameterAsText(5)
   width = arcpy.GetParameterAsText(6)
 
-  # Check the input and make sure
-  # 1) the data has sequential OIDs
-  # 2) an attachment table can be found
-  attachTable, seq = checks(inputFeatures)
+  # Check the input and make sure an attachment table can be found,
+  # and read the OID of every feature to match placemarks to their attachments
+  attachTable, oids = checks(inputFeatures)
 
   if attachTable is None:
     arcpy.AddError("Could not find an attachment table. Ensure the attachment table is properly")
     arcpy.AddError("referenced through a relationship class in the same workspace as the input features.")
     sys.exit()
 
-  if not seq:
-    arcpy.AddWarning("It appears the OIDs for the input featureclass are NOT sequential.")
-    arcpy.AddWarning("Attachment logic depends on sequential OIDs.")
-    arcpy.AddWarning("A temporary ID field needs to be added to your data to attempt to reconcile this.")
-
-    # Can only proceed if we're permitted to add a new field to the input data.
-    if not uniqueID:
-      arcpy.AddError("You need to check the Allow Unique ID parameter (re-run tool and set to True).")
-      arcpy.AddError("Note: This will add a field to your data, calc, and eventually remove it.")
-      arcpy.AddError("To maintain the integrity of your data, make a copy of your data and provide this as input.")
-      sys.exit()
-    else: # Add the new ID field to the data
-      import uuid
-      arcpy.AddField_management(inputFeatures, "tempIDField", "TEXT")
-      edit = arcpy.da.Editor(arcpy.Describe(inputFeatures).path)
-      edit.startEditing(False, False)
-
-      with arcpy.da.UpdateCursor(inputFeatures, ["tempIDField"]) as cursor:
-        for row in cursor:
-          row[0] = str(uuid.uuid4().hex.upper()[0:16])
-          cursor.updateRow(row)
-      edit.stopEditing(True)
-      arcpy.AddMessage("A temporary field was added to your data and will be removed when tool completes.")
-
   # Create KML file
   arcpy.LayerToKML_conversion(inputFeatures, outputKML, outputScale, ignore_zvalue=clamped)
 
-  # Make new files directory, copy all images inside
-  KMLdir = os.path.join(os.path.dirname(outputKML), "kml_extracted")
-  if not os.path.exists(KMLdir):
-    os.mkdir(KMLdir)
-  KMLfiles = os.path.join(KMLdir, "files")
-  if not os.path.exists(KMLfiles):
-    os.mkdir(KMLfiles)
-
-  # Rename the KML to ZIP and extract it
+  # Rename the KMZ to ZIP, it is the source of the new KMZ
   root, kmlext = os.path.splitext(outputKML)
   os.rename(outputKML, root + ".zip")
 
-  with zipfile.ZipFile(root + ".zip", "r") as z:
-    z.extractall(KMLdir)
-
-  # Inject images into .kmz and save
-  docKML = os.path.join(KMLdir, "doc.kml")
-
-  # Place the attachments inside the KMZ
-  attachments(KMLfiles, KMLdir, attachTable, seq, uniqueID, height, width)
-  if uniqueID:
-    arcpy.DeleteField_management(inputFeatures, "tempIDField")
-
-  # Remove the original KMZ (zip) as it'll be made new again
+  # Build the new KMZ straight from the source: entries other than doc.kml are copied as they are,
+  # attachments are written from the attachment table and doc.kml is rewritten to show them
+  with zipfile.ZipFile(root + ".zip", "r") as source:
+    with zipfile.ZipFile(outputKML, "w", zipfile.ZIP_DEFLATED) as kmz:
+      for info in source.infolist():
+        if info.filename != "doc.kml":
+          entry = zipfile.ZipInfo(info.filename, info.date_time)
+          entry.external_attr = info.external_attr
+          entry.compress_type = compression(info.filename)
+          kmz.writestr(entry, source.read(info.filename))
+
+      # Place the attachments inside the KMZ
+      attachments(source, kmz, attachTable, oids, height, width)
+
+  # Remove the original KMZ (zip)
   os.remove(root + ".zip")
-
-  # zip everything back up
-  zipf = zipfile.ZipFile(root + ".zip", 'w')
-  for rootdir, dirs, files in os.walk(KMLdir):
-    for f in files:
-      zipf.write(os.path.join(rootdir, f), os.path.relpath(os.path.join(rootdir, f), KMLdir))
-  zipf.close()
-
-  # Rename ZIP back to KMZ
-  os.rename(root + ".zip", outputKML)
-
-  # Clean up the KML dir
-  shutil.rmtree(KMLdir)
@@ -10,6 +10,10 @@
               File Type (String)
  Derived output:
               Output Dataset (Feature Class or Table)
+ Python-only options (not in ToAttachment.tbx; read from script arguments 4-10
+ if matching parameters are added to a copy of the script tool):
+              workers, resume, rasterWorkers, direct, cacheDir, batchSize,
+              hostConnections
 
  Description: Adds geodatabase attachments to input dataset, based on files stored
               in a raster or blob field, or hyperlinked to.
@@ -18,19 +22,837 @@
 # Import system modules
 import arcpy
 import re
+import io
 import os
+import sys
 import csv
-import urllib2
+import json
+import time
+import random
+import socket
+import hashlib
+import threading
 import datetime
+import mimetypes
+import multiprocessing
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
 try:
-    from urllib.request import urlopen as urlopen
+    from urllib.request import urlopen as urlopen, Request
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlparse
+    from http.client import HTTPException
 except:
-    from urllib2 import urlopen as urlopen
+    from urllib2 import urlopen as urlopen, Request, HTTPError, URLError
+    from urlparse import urlparse
+    from httplib import HTTPException
 
 arcpy.env.overwriteOutput = True
 
-# Main function, all functions run in SpatialJoinOverlapsCrossings
-def ToAttachments(in_dataset, field, ftype="", hyperlinkDir=""):
+# Number of concurrent downloads used for hyperlinked files
+DOWNLOAD_WORKERS = 8
+# Downloads are streamed to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Largest file (in bytes) that will be downloaded, None for no limit
+MAX_DOWNLOAD_SIZE = 1024 * 1024 * 1024
+# BLOBs are written in slices of this many bytes, None to write each in one call
+BLOB_WRITE_CHUNK_SIZE = None
+# Bytes of downloaded files kept by the HTTP cache before the least recently used are evicted
+HTTP_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# Cached files are named by the SHA-1 of their URL
+CACHE_FILE_NAME = re.compile(r"^[0-9a-f]{40}$")
+# Downloaded files are attached in batches of this many, None to attach all of them at the end
+ATTACH_BATCH_SIZE = 500
+# Concurrent downloads allowed from any one host
+HOST_CONNECTIONS = 4
+# Times a download is retried after a transient failure
+DOWNLOAD_RETRIES = 3
+# First and largest delay (seconds) when backing off a host which throttles or fails
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# A host is slowed down when its response time grows past this multiple of its best
+LATENCY_FACTOR = 3.0
+# HTTP status codes worth retrying
+TRANSIENT_HTTP_CODES = (429, 500, 502, 503, 504)
+# Network failures worth retrying. On Python 3 socket.error is OSError, which would
+# also catch local disk and file name errors, so connection errors are named instead
+try:
+    NETWORK_ERRORS = (URLError, HTTPException, socket.timeout, ConnectionError)
+except NameError:
+    NETWORK_ERRORS = (URLError, HTTPException, socket.timeout, socket.error)
+# Missing files listed individually in the summary warning
+MISSING_REPORT_LIMIT = 20
+# Lossless raster formats (as reported by Describe) and the file extension which keeps them as they are.
+# Rasters in any other format, including JPEG and JPEG 2000, are exported to TIFF unless a File Type
+# is given, as writing them in their own format would encode them a second time with loss
+RASTER_FORMATS = {"PNG": "png", "GIF": "gif", "BMP": "bmp", "TIFF": "tif", "IMAGINE Image": "img"}
+# Image files which a raster field can reference and which are attached without a copy
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "gif", "bmp", "tif", "tiff", "jp2")
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+def openMatchTable(path, mode='w'):
+    """Open a CSV match table for reading or writing under Python 2 or 3."""
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return open(path, mode, newline='')
+
+
+class MatchTableWriter(object):
+    """CSV writer for the match table. With flush, every row is flushed to disk
+    so the table doubles as a journal of completed OIDs if a run is interrupted."""
+    def __init__(self, f, flush=False):
+        self.f = f
+        self.writer = csv.writer(f)
+        self.flush = flush
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        if self.flush:
+            self.f.flush()
+
+
+def readJournal(matchtable):
+    """Return the (oid, path) rows of a match table left by an earlier run whose
+    files still exist."""
+    rows = []
+    if os.path.exists(matchtable):
+        with openMatchTable(matchtable, 'r') as f:
+            for row in csv.DictReader(f):
+                try:
+                    if os.path.exists(row["FILE"]):
+                        rows.append((int(row["OID"]), row["FILE"]))
+                except (KeyError, TypeError, ValueError):
+                    pass
+    return rows
+
+
+def attachmentKeys(in_dataset, attachTable):
+    """Attachments are related by ObjectID, or by GlobalID on datasets which have
+    them. Return the field of attachTable which relates them to in_dataset, and
+    None for REL_OBJECTID or a dictionary of each record's OID to its GlobalID."""
+    if "REL_OBJECTID" in [f.name.upper() for f in arcpy.ListFields(attachTable)]:
+        return "REL_OBJECTID", None
+    globalIDField = arcpy.Describe(in_dataset).globalIDFieldName
+    with arcpy.da.SearchCursor(in_dataset, ["OID@", globalIDField]) as scur:
+        return "REL_GLOBALID", dict((row[0], row[1]) for row in scur)
+
+
+def attachedOIDs(in_dataset):
+    """Return the set of OIDs which already have geodatabase attachments."""
+    attachTable = arcpy.Describe(in_dataset).catalogPath + "__ATTACH"
+    if not arcpy.Exists(attachTable):
+        return set()
+    relField, keys = attachmentKeys(in_dataset, attachTable)
+    with arcpy.da.SearchCursor(attachTable, [relField]) as scur:
+        related = set(row[0] for row in scur)
+    if keys is None:
+        return related
+    return set(oid for oid, key in keys.items() if key in related)
+
+
+def streamToFile(source, path, chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE):
+    """Copy a file-like source to path in chunks, so memory use does not depend
+    on the size of the file. Returns the number of bytes written and the SHA-1
+    hex digest of the content, which is hashed as it streams."""
+    size = 0
+    sha1 = hashlib.sha1()
+    try:
+        with open(path, "wb") as localFile:
+            while True:
+                chunk = source.read(chunkSize)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if maxSize and size > maxSize:
+                    raise DownloadTooLarge("File is larger than {0} bytes.".format(maxSize))
+                sha1.update(chunk)
+                localFile.write(chunk)
+    except:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return size, sha1.hexdigest()
+
+
+def writeBuffer(path, data, chunkSize=BLOB_WRITE_CHUNK_SIZE):
+    """Write a buffer, such as the memoryview a cursor returns for a BLOB, to
+    path without copying it into a new bytes object. The file is unbuffered so
+    the data goes straight from the cursor's buffer to the operating system.
+    With chunkSize the buffer is written in slices (views, not copies)."""
+    view = memoryview(data)
+    end = len(view)
+    step = chunkSize or end
+    with io.open(path, "wb", buffering=0) as f:
+        pos = 0
+        while pos < end:
+            pos += f.write(view[pos:pos + step])
+
+
+def shareBuffer(source, path, data, chunkSize=BLOB_WRITE_CHUNK_SIZE):
+    """Give path the content of source, a file already written with the same
+    data, so each row keeps its own attachment name. A hard link stores the
+    content once; where links are not supported the data is written again."""
+    try:
+        os.link(source, path)
+    except (AttributeError, OSError):
+        writeBuffer(path, data, chunkSize)
+
+
+def linkFile(source, path):
+    """Replace path, a file with the same content as source, by a hard link to
+    source so the content is stored once. Where links are not supported path
+    is kept as it is."""
+    linked = path + ".link"
+    try:
+        os.link(source, linked)
+    except (AttributeError, OSError):
+        return
+    os.remove(path)
+    os.rename(linked, path)
+
+
+def readToMemory(source, chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE):
+    """Read a file-like source in chunks into a single bytearray, which is
+    returned as is; copying it to bytes would hold the file in memory twice."""
+    data = bytearray()
+    while True:
+        chunk = source.read(chunkSize)
+        if not chunk:
+            break
+        data.extend(chunk)
+        if maxSize and len(data) > maxSize:
+            raise DownloadTooLarge("File is larger than {0} bytes.".format(maxSize))
+    return data
+
+
+def checkLength(u, maxSize=MAX_DOWNLOAD_SIZE):
+    """Refuse a response which announces it is over the limit before reading it."""
+    length = u.info().get("Content-Length")
+    if maxSize and length and int(length) > maxSize:
+        u.close()
+        raise DownloadTooLarge("File is larger than {0} bytes.".format(maxSize))
+    return u
+
+
+def openURL(url, maxSize=MAX_DOWNLOAD_SIZE, cache=None, limiter=None):
+    """Open a hyperlink for reading, through the HTTP cache if one is given.
+    The response time is reported to the host limiter if one is given."""
+    start = time.time()
+    if cache is not None:
+        u = cache.open(url, maxSize)
+    else:
+        u = checkLength(urlopen(url), maxSize)
+    if limiter is not None:
+        limiter.observe(url, time.time() - start)
+    return u
+
+
+class HostLimiter(object):
+    """Limits the number of concurrent downloads from each host and backs off
+    hosts which throttle (429 / 503), fail transiently or slow down.
+
+    Transient failures are retried up to retries times. After each one the host
+    gets an exponentially growing delay, with random jitter so that concurrent
+    requests do not all retry at once."""
+    def __init__(self, perHost=HOST_CONNECTIONS, retries=DOWNLOAD_RETRIES):
+        self.perHost = max(1, int(perHost))
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.delay = {}      # current backoff per host, in seconds
+        self.notBefore = {}  # time before which no new request goes to a host
+        self.latency = {}    # moving average of the response time per host
+        self.baseline = {}   # best moving average seen per host
+
+    def host(self, url):
+        return urlparse(url).netloc.lower()
+
+    def slot(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.Semaphore(self.perHost)
+            return self.slots[host]
+
+    def wait(self, host):
+        with self.lock:
+            pause = self.notBefore.get(host, 0) - time.time()
+        if pause > 0:
+            time.sleep(pause)
+
+    def backOff(self, host, retryAfter=None):
+        with self.lock:
+            now = time.time()
+            if self.notBefore.get(host, 0) > now + (retryAfter or 0):
+                # Already backing off; requests which were in flight do not escalate it again
+                return
+            delay = min(BACKOFF_MAX, max(BACKOFF_BASE, self.delay.get(host, 0) * 2))
+            self.delay[host] = delay
+            pause = max(random.uniform(delay / 2, delay), retryAfter or 0)
+            self.notBefore[host] = max(self.notBefore.get(host, 0), now + pause)
+
+    def observe(self, url, seconds):
+        """Record the response time of a request and slow down the host if it
+        is rising; otherwise let any earlier backoff decay."""
+        host = self.host(url)
+        with self.lock:
+            average = self.latency.get(host)
+            average = seconds if average is None else 0.8 * average + 0.2 * seconds
+            self.latency[host] = average
+            self.baseline[host] = min(self.baseline.get(host, average), average)
+            if average > LATENCY_FACTOR * self.baseline[host]:
+                pause = random.uniform(0, average)
+                self.notBefore[host] = max(self.notBefore.get(host, 0), time.time() + pause)
+            else:
+                delay = self.delay.get(host, 0) / 2
+                self.delay[host] = delay if delay >= BACKOFF_BASE else 0
+
+    def run(self, url, attempt):
+        """Call attempt() within the host's connection limit, retrying transient
+        failures. The last failure is raised when the retries are used up."""
+        host = self.host(url)
+        for n in range(self.retries + 1):
+            self.wait(host)
+            with self.slot(host):
+                try:
+                    return attempt()
+                except HTTPError as e:
+                    if e.code not in TRANSIENT_HTTP_CODES or n == self.retries:
+                        raise
+                    retryAfter = e.headers.get("Retry-After") if e.headers else None
+                    self.backOff(host, int(retryAfter) if retryAfter and retryAfter.isdigit() else None)
+                except NETWORK_ERRORS:
+                    if n == self.retries:
+                        raise
+                    self.backOff(host)
+
+
+class CachingResponse(object):
+    """Wraps an HTTP response, copying the body into the cache as it is read.
+    The copy is only kept if the whole body was read."""
+    def __init__(self, response, cache, url):
+        self.response = response
+        self.cache = cache
+        self.url = url
+        self.tempPath = cache.tempPath()
+        self.f = open(self.tempPath, "wb")
+        self.complete = False
+
+    def info(self):
+        return self.response.info()
+
+    def read(self, size=-1):
+        chunk = self.response.read(size)
+        if chunk:
+            self.f.write(chunk)
+        else:
+            self.complete = True
+        return chunk
+
+    def close(self):
+        self.response.close()
+        self.f.close()
+        if self.complete:
+            self.cache.store(self.url, self.tempPath, self.response.info())
+        elif os.path.exists(self.tempPath):
+            os.remove(self.tempPath)
+
+
+class HTTPCache(object):
+    """Persistent on-disk cache of downloaded files, keyed by URL.
+
+    Cached files are revalidated with conditional requests (If-None-Match and
+    If-Modified-Since) and reused when the server answers 304 Not Modified.
+    When the cached files exceed maxBytes, the least recently used are evicted."""
+    def __init__(self, cacheDir, maxBytes=HTTP_CACHE_SIZE):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.indexPath = os.path.join(cacheDir, "index.json")
+        self.lock = threading.Lock()
+        self.entries = {}
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        if os.path.exists(self.indexPath):
+            try:
+                with open(self.indexPath) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+        # Forget entries whose files have gone
+        self.entries = dict((url, e) for url, e in self.entries.items()
+                            if os.path.exists(os.path.join(cacheDir, e["file"])))
+        # Remove files the index does not know about: bodies stored after the last save
+        # and partial downloads of a run which was killed. They would never be evicted
+        known = set(e["file"] for e in self.entries.values())
+        for name in os.listdir(cacheDir):
+            if name not in known and (CACHE_FILE_NAME.match(name) or name.startswith("tmp_")):
+                try:
+                    os.remove(os.path.join(cacheDir, name))
+                except OSError:
+                    pass
+
+    def tempPath(self):
+        with self.lock:
+            return os.path.join(self.cacheDir, "tmp_{0}_{1}".format(threading.current_thread().ident, time.time()))
+
+    def open(self, url, maxSize=MAX_DOWNLOAD_SIZE, conditional=True):
+        request = Request(url)
+        with self.lock:
+            entry = self.entries.get(url) if conditional else None
+        if entry:
+            if entry.get("etag"):
+                request.add_header("If-None-Match", entry["etag"])
+            if entry.get("lastModified"):
+                request.add_header("If-Modified-Since", entry["lastModified"])
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            if e.code == 304 and entry:
+                with self.lock:
+                    if self.entries.get(url) is entry:
+                        entry["used"] = time.time()
+                        return open(os.path.join(self.cacheDir, entry["file"]), "rb")
+                # The file was evicted while it was being revalidated
+                return self.open(url, maxSize, conditional=False)
+            raise
+        checkLength(response, maxSize)
+        headers = response.info()
+        if not headers.get("ETag") and not headers.get("Last-Modified"):
+            # Without validators the file could never be revalidated, so it is not cached
+            return response
+        return CachingResponse(response, self, url)
+
+    def store(self, url, tempPath, headers):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        path = os.path.join(self.cacheDir, name)
+        with self.lock:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(tempPath, path)
+            except OSError:
+                # The cached copy is still open by another reader; keep it
+                os.remove(tempPath)
+                return
+            self.entries[url] = {"file": name, "etag": headers.get("ETag"),
+                                 "lastModified": headers.get("Last-Modified"),
+                                 "size": os.path.getsize(path), "used": time.time()}
+            self.evict(keep=url)
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the cache fits in maxBytes."""
+        total = sum(e["size"] for e in self.entries.values())
+        for url, entry in sorted(self.entries.items(), key=lambda item: item[1]["used"]):
+            if total <= self.maxBytes:
+                break
+            if url == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cacheDir, entry["file"]))
+            except OSError:
+                continue
+            total -= entry["size"]
+            del self.entries[url]
+
+    def save(self):
+        with self.lock:
+            with open(self.indexPath, "w") as f:
+                json.dump(self.entries, f)
+
+
+def fetchFile(item, chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE, cache=None, limiter=None):
+    """Download one (oid, url) item into memory.
+    Returns (oid, url, content or None, reason)."""
+    oid, url = item
+
+    def attempt():
+        u = openURL(url, maxSize, cache, limiter)
+        try:
+            return readToMemory(u, chunkSize, maxSize)
+        finally:
+            u.close()
+
+    try:
+        data = limiter.run(url, attempt) if limiter is not None else attempt()
+        return oid, url, data, None
+    except DownloadTooLarge as e:
+        return oid, url, None, str(e)
+    except:
+        return oid, url, None, None
+
+
+def downloadFile(item, filedir, chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE, cache=None,
+                 limiter=None):
+    """Download one (oid, url) item.
+    Returns (oid, url, local path or None, content digest, reason)."""
+    oid, url = item
+
+    def attempt():
+        u = openURL(url, maxSize, cache, limiter)
+        try:
+            # Each OID gets its own folder so files with the same name cannot collide
+            oiddir = os.path.join(filedir, str(oid))
+            if not os.path.exists(oiddir):
+                os.mkdir(oiddir)
+            newname = os.path.join(oiddir, os.path.basename(url))
+            size, digest = streamToFile(u, newname, chunkSize, maxSize)
+            return newname, digest
+        finally:
+            u.close()
+
+    try:
+        newname, digest = limiter.run(url, attempt) if limiter is not None else attempt()
+        return oid, url, newname, digest, None
+    except DownloadTooLarge as e:
+        return oid, url, None, None, str(e)
+    except:
+        return oid, url, None, None, None
+
+
+class DownloadPool(object):
+    """Runs a download task on a thread pool once for each distinct URL of
+    (oid, url) pairs. Iterating yields (task result, OIDs referencing the URL)
+    as downloads complete; the task's result must start with (oid, url).
+
+    With slots, a semaphore, a slot is taken before each download starts and
+    the caller releases it once it is done with the result, which bounds the
+    downloads in flight or waiting to be used."""
+    def __init__(self, urls, task, workers=DOWNLOAD_WORKERS, slots=None):
+        self.oidsByUrl = OrderedDict()
+        for oid, url in urls:
+            self.oidsByUrl.setdefault(url, []).append(oid)
+        self.task = task
+        self.workers = max(1, int(workers))
+        self.slots = slots
+        self.stopped = False
+
+    def throttled(self, items):
+        # Runs on the pool's task thread; waits for a free slot before each download starts
+        for item in items:
+            if self.slots is not None:
+                self.slots.acquire()
+                if self.stopped:
+                    return
+            yield item
+
+    def __enter__(self):
+        self.pool = ThreadPool(self.workers)
+        return self
+
+    def __iter__(self):
+        items = [(oids[0], url) for url, oids in self.oidsByUrl.items()]
+        for result in self.pool.imap_unordered(self.task, self.throttled(items)):
+            yield result, self.oidsByUrl[result[1]]
+
+    def __exit__(self, *args):
+        if self.slots is not None:
+            # Let the task thread finish if it is waiting for a slot
+            self.stopped = True
+            self.slots.release()
+        self.pool.close()
+        self.pool.join()
+        return False
+
+
+def downloadFiles(urls, filedir, writer, workers=DOWNLOAD_WORKERS,
+                  chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE, seen=None, cache=None,
+                  batchSize=None, commit=None, limiter=None):
+    """Download (oid, url) pairs on a bounded thread pool, writing the OID and
+    local path of each completed file to the match table writer.
+
+    Each distinct URL is requested once and shared by every OID referencing it.
+    Files whose content was already materialised (seen maps content digest to
+    local path) keep their own name, which becomes the attachment name, but are
+    replaced by a hard link to the existing copy where links are supported.
+
+    With batchSize and commit, each batch of batchSize downloaded files is
+    passed to commit as (oid, path) rows and then deleted, while the next batch
+    keeps downloading. At most two batches of files are on disk at once."""
+    if seen is None:
+        seen = {}
+    batch = []
+    batchFiles = []
+    slots = threading.Semaphore(2 * batchSize) if batchSize else None
+
+    def commitBatch():
+        commit(batch)
+        for path in batchFiles:
+            os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+            slots.release()
+        del batch[:]
+        del batchFiles[:]
+        # Files of committed batches are gone, so they cannot be shared any longer
+        seen.clear()
+
+    download = partial(downloadFile, filedir=filedir, chunkSize=chunkSize, maxSize=maxSize, cache=cache,
+                       limiter=limiter)
+    with DownloadPool(urls, download, workers, slots) as downloads:
+        for (oid, url, newname, digest, reason), oids in downloads:
+            if newname:
+                if digest in seen:
+                    linkFile(seen[digest], newname)
+                else:
+                    seen[digest] = newname
+                batchFiles.append(newname)
+            else:
+                if slots is not None:
+                    slots.release()
+                if reason:
+                    arcpy.AddWarning(reason)
+            for oid in oids:
+                if newname:
+                    writer.writerow([str(oid), newname])
+                    batch.append((oid, newname))
+                else:
+                    arcpy.AddWarning("Cannot process file {0} for OID {1}".format(url, oid))
+                arcpy.SetProgressorPosition()
+            if batchSize and len(batchFiles) >= batchSize:
+                commitBatch()
+        if batchSize and batch:
+            commitBatch()
+
+
+def attachFiles(in_dataset, oidfield, filedir, rows):
+    """Attach (oid, path) rows to the dataset with AddAttachments through a
+    temporary match table."""
+    batchtable = os.path.join(filedir, "batch.txt")
+    with openMatchTable(batchtable) as f:
+        writer = csv.writer(f)
+        writer.writerow(["OID", "FILE"])
+        for oid, path in rows:
+            writer.writerow([str(oid), path])
+    arcpy.management.AddAttachments(in_dataset, oidfield, batchtable, "OID", "FILE")
+    os.remove(batchtable)
+
+
+class AttachmentInserter(object):
+    """Inserts attachments straight into the __ATTACH table of a dataset through
+    one InsertCursor in an edit session, with no intermediate files. Attachments
+    must already be enabled on the dataset."""
+    def __init__(self, in_dataset):
+        desc = arcpy.Describe(in_dataset)
+        self.attachTable = desc.catalogPath + "__ATTACH"
+        self.workspace = desc.path
+        if arcpy.Describe(self.workspace).dataType == "FeatureDataset":
+            self.workspace = os.path.dirname(self.workspace)
+
+        relField, self.keys = attachmentKeys(in_dataset, self.attachTable)
+        self.fields = [relField, "CONTENT_TYPE", "ATT_NAME", "DATA_SIZE", "DATA"]
+
+    def __enter__(self):
+        self.editor = arcpy.da.Editor(self.workspace)
+        self.editor.startEditing(False, False)
+        self.editor.startOperation()
+        self.cursor = arcpy.da.InsertCursor(self.attachTable, self.fields)
+        return self
+
+    def insert(self, oid, name, data):
+        key = self.keys[oid] if self.keys is not None else oid
+        contentType = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.cursor.insertRow([key, contentType, name, len(data), data])
+
+    def insertFiles(self, rows):
+        """Insert the files of (oid, path) rows, such as the journal of an
+        interrupted run, reading one file at a time."""
+        for oid, path in rows:
+            with open(path, "rb") as f:
+                self.insert(oid, os.path.basename(path), f.read())
+
+    def __exit__(self, *args):
+        del self.cursor
+        # Attachments inserted before a failure are kept, so a resumed run can skip them
+        self.editor.stopOperation()
+        self.editor.stopEditing(True)
+        return False
+
+
+def downloadAttachments(urls, inserter, workers=DOWNLOAD_WORKERS,
+                        chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE, cache=None, limiter=None):
+    """Download (oid, url) pairs on a bounded thread pool and insert each file
+    directly into the attachment table. Each distinct URL is requested once.
+    At most two files per worker are held in memory: one downloading and one
+    waiting to be inserted."""
+    slots = threading.Semaphore(2 * max(1, int(workers)))
+    fetch = partial(fetchFile, chunkSize=chunkSize, maxSize=maxSize, cache=cache, limiter=limiter)
+    with DownloadPool(urls, fetch, workers, slots) as downloads:
+        for (oid, url, data, reason), oids in downloads:
+            if data is None and reason:
+                arcpy.AddWarning(reason)
+            for oid in oids:
+                if data is not None:
+                    inserter.insert(oid, os.path.basename(url), data)
+                else:
+                    arcpy.AddWarning("Cannot process file {0} for OID {1}".format(url, oid))
+                arcpy.SetProgressorPosition()
+            data = None
+            slots.release()
+
+
+def downloadToAttachments(in_dataset, oidfield, urls, filedir, f, writer, matchtable,
+                          direct=False, batchSize=ATTACH_BATCH_SIZE, workers=DOWNLOAD_WORKERS,
+                          chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE, cache=None, limiter=None,
+                          journal=()):
+    """Download (oid, url) pairs and attach them to the dataset, either directly,
+    in pipelined batches or with one AddAttachments call at the end. The
+    (oid, path) rows of an interrupted run's journal are attached first."""
+    if direct:
+        # Insert the downloads straight into the attachment table
+        f.close()
+        arcpy.management.EnableAttachments(in_dataset)
+        with AttachmentInserter(in_dataset) as inserter:
+            inserter.insertFiles(journal)
+            downloadAttachments(urls, inserter, workers, chunkSize, maxSize, cache, limiter)
+    elif batchSize:
+        # Attach each batch while the next one downloads
+        arcpy.management.EnableAttachments(in_dataset)
+        commit = partial(attachFiles, in_dataset, oidfield, filedir)
+        if journal:
+            # Only the rows of each batch are attached, so the journal is attached on its own
+            commit(journal)
+        downloadFiles(urls, filedir, writer, workers, chunkSize, maxSize, cache=cache,
+                      batchSize=batchSize, commit=commit, limiter=limiter)
+        f.close()
+    else:
+        downloadFiles(urls, filedir, writer, workers, chunkSize, maxSize, cache=cache, limiter=limiter)
+        # Enable geodatabase attachments and write intermediate files to gdb
+        f.close()
+        arcpy.management.EnableAttachments(in_dataset)
+        arcpy.management.AddAttachments(in_dataset, oidfield, matchtable, "OID", "FILE")
+
+
+def checkPath(item):
+    """Check one (oid, path) item. Returns (oid, path, whether the file exists)."""
+    oid, path = item
+    try:
+        return oid, path, os.path.isfile(path)
+    except:
+        return oid, path, False
+
+
+def validatePaths(rows, workers=DOWNLOAD_WORKERS):
+    """Check that the files of (oid, path) rows exist, in parallel on a thread
+    pool since each check may be a network round trip on a UNC share. Missing
+    files are reported in one summary and the rows with files are returned."""
+    valid = []
+    missing = []
+    pool = ThreadPool(max(1, int(workers)))
+    try:
+        for oid, path, exists in pool.imap_unordered(checkPath, rows, 64):
+            if exists:
+                valid.append((oid, path))
+            else:
+                missing.append((oid, path))
+            arcpy.SetProgressorPosition()
+    finally:
+        pool.close()
+        pool.join()
+
+    if missing:
+        missing.sort()
+        arcpy.AddWarning("{0} of {1} records reference files which do not exist and were skipped.".format(len(missing), len(rows)))
+        for oid, path in missing[:MISSING_REPORT_LIMIT]:
+            arcpy.AddWarning("  OID {0}: {1}".format(oid, path))
+        if len(missing) > MISSING_REPORT_LIMIT:
+            arcpy.AddWarning("  ... and {0} more.".format(len(missing) - MISSING_REPORT_LIMIT))
+    return valid
+
+
+def attachPaths(in_dataset, oidfield, rows, f, writer, matchtable, workers=DOWNLOAD_WORKERS):
+    """Attach the files referenced by (oid, path) rows, validating every path
+    first so that only rows whose files exist reach AddAttachments."""
+    for oid, path in validatePaths(rows, workers):
+        writer.writerow([str(oid), path])
+    f.close()
+    arcpy.management.EnableAttachments(in_dataset)
+    arcpy.management.AddAttachments(in_dataset, oidfield, matchtable, "OID", "FILE")
+    arcpy.AddWarning(arcpy.GetMessages(1))
+
+
+def rasterSource(inraster):
+    """Describe a raster field value. Returns (image file, None) for a raster
+    which references an image file on disk, to be attached as it is, and
+    otherwise (None, extension of its export): its own format where that is
+    lossless and TIFF otherwise, so no quality is lost."""
+    desc = arcpy.Describe(inraster)
+    source = getattr(desc, "catalogPath", "")
+    if source and os.path.isfile(source) and os.path.splitext(source)[1][1:].lower() in IMAGE_EXTENSIONS:
+        return source, None
+    return None, RASTER_FORMATS.get(getattr(desc, "format", ""), "tif")
+
+
+def rasterExtension(inraster, ftype=""):
+    """Return the extension the rasters of a field are exported to, resolved once
+    per field from one of its rasters: ftype if given, otherwise that of
+    rasterSource. None means the field references image files on disk, or could
+    not be described, and each raster is resolved by its export."""
+    if ftype:
+        return ftype.lower()
+    try:
+        return rasterSource(inraster)[1]
+    except:
+        return None
+
+
+def exportRaster(task):
+    """Copy one raster field value to an image file. Runs in a worker process.
+    Without an extension (see rasterExtension) the raster is described here, and
+    one which references an image file on disk is attached as it is.
+    Returns (oid, image path or None)."""
+    oid, inraster, basename, extension = task
+    try:
+        if extension is None:
+            source, extension = rasterSource(inraster)
+            if source:
+                return oid, source
+        newname = "{0}.{1}".format(basename, extension)
+        arcpy.management.CopyRaster(inraster, newname)
+        return oid, newname
+    except:
+        return oid, None
+
+
+def exportRasters(tasks, writer, processes=None):
+    """Run the (oid, raster, image base name, extension) exports across a process pool, writing
+    the OID and image path of each completed export to the match table writer."""
+    if not tasks:
+        return
+    # Inside ArcMap / ArcGIS Pro sys.executable is the application, not python
+    if not os.path.basename(sys.executable).lower().startswith("python"):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, (oid, newname) in enumerate(pool.imap_unordered(exportRaster, tasks), 1):
+            arcpy.SetProgressorLabel("Processing record {0}/{1}".format(i, len(tasks)))
+            if newname:
+                writer.writerow([str(oid), newname])
+            else:
+                arcpy.AddWarning("Cannot process raster field for OID {0}.".format(oid))
+            arcpy.SetProgressorPosition()
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Main function, all functions run in ToAttachments
+def ToAttachments(in_dataset, field, ftype="", hyperlinkDir="", workers=DOWNLOAD_WORKERS,
+                  chunkSize=DOWNLOAD_CHUNK_SIZE, maxSize=MAX_DOWNLOAD_SIZE, resume=False,
+                  rasterWorkers=None, blobChunkSize=BLOB_WRITE_CHUNK_SIZE, direct=False,
+                  cacheDir=None, cacheSize=HTTP_CACHE_SIZE, batchSize=ATTACH_BATCH_SIZE,
+                  hostConnections=HOST_CONNECTIONS, retries=DOWNLOAD_RETRIES):
+    filedir = None
+    completed = False
+    cache = HTTPCache(cacheDir, cacheSize) if cacheDir else None
+    limiter = HostLimiter(hostConnections, retries)
     try:
         # Error if sufficient license is not available
         if arcpy.ProductInfo().lower() not in ['arcinfo', 'arceditor']:
@@ -47,22 +869,70 @@ def ToAttachments(in_dataset, field, ftype="", hyperlinkDir=""):
         count = int(arcpy.management.GetCount(in_dataset).getOutput(0))
 
         # Create a folder to store intermediate files on disk
-        filedir = arcpy.management.CreateFolder("%scratchfolder%", "files_{0}".format(datetime.datetime.strftime(datetime.datetime.now(), "%d%m%Y%H%M%S")))
+        if resume:
+            # The same inputs always use the same folder, so a rerun finds the journal of an interrupted run
+            key = hashlib.sha1("{0}|{1}".format(arcpy.Describe(in_dataset).catalogPath, field).lower().encode("utf-8")).hexdigest()
+            filedir = os.path.join(arcpy.env.scratchFolder, "files_{0}".format(key[:16]))
+            if not os.path.exists(filedir):
+                os.makedirs(filedir)
+        else:
+            filedir = arcpy.management.CreateFolder("%scratchfolder%", "files_{0}".format(datetime.datetime.strftime(datetime.datetime.now(), "%d%m%Y%H%M%S")))
         # Write ObjectIDs to matching file
         matchtable = os.path.join(str(filedir), "match.txt")
-        with open(matchtable, 'wb') as f:
-            writer = csv.writer(f)
+
+        # OIDs which already have attachments or were materialised by an interrupted run are skipped
+        done = set()
+        journal = []
+        if resume:
+            done = attachedOIDs(in_dataset)
+            journal = [(oid, path) for oid, path in readJournal(matchtable) if oid not in done]
+            done.update(oid for oid, path in journal)
+            if done:
+                arcpy.AddMessage("Resuming: {0} records were already processed.".format(len(done)))
+
+        with openMatchTable(matchtable) as f:
+            writer = MatchTableWriter(f, resume)
             writer.writerow(["OID", "FILE"])
+            for oid, path in journal:
+                writer.writerow([str(oid), path])
 
             # If working with a blob field
-            if type == "blob":
+            if type == "blob" and direct:
+                arcpy.SetProgressor("step", "Processing BLOBs in field {0}".format(field), 0, count, 1)
+                f.close()
+                arcpy.management.EnableAttachments(in_dataset)
+                # Insert the BLOBs straight into the attachment table
+                with arcpy.da.SearchCursor(in_dataset, ["OID@", field]) as scur, AttachmentInserter(in_dataset) as inserter:
+                    inserter.insertFiles(journal)
+                    for row in scur:
+                        if row[0] in done:
+                            arcpy.SetProgressorPosition()
+                            continue
+                        try:
+                            inserter.insert(row[0], "file_{0}.{1}".format(row[0], ftype), row[1])
+                        except:
+                            arcpy.AddWarning("Cannot process BLOB for OID {0}.".format(row[0]))
+                        finally:
+                            arcpy.SetProgressorPosition()
+
+            elif type == "blob":
                 arcpy.SetProgressor("step", "Processing BLOBs in field {0}".format(field), 0, count, 1)
                 with arcpy.da.SearchCursor(in_dataset, ["OID@", field]) as scur:
                     # Read through the dataset, harvest files from blob, write to folder, then keep track of OIDs
+                    # Identical BLOBs are stored once and hard linked, keyed by a hash of their content
+                    seen = {}
                     for row in scur:
+                        if row[0] in done:
+                            arcpy.SetProgressorPosition()
+                            continue
                         try:
+                            digest = hashlib.sha1(row[1]).hexdigest()
                             path = os.path.join(str(filedir), "file_{0}.{1}".format(row[0], ftype))
-                            open(path, "wb").write(row[1].tobytes())
+                            if digest in seen:
+                                shareBuffer(seen[digest], path, row[1], blobChunkSize)
+                            else:
+                                writeBuffer(path, row[1], blobChunkSize)
+                                seen[digest] = path
                             writer.writerow([str(row[0]), path])
                         except:
                             arcpy.AddWarning("Cannot process BLOB for OID {0}.".format(row[0]))
@@ -75,19 +945,20 @@ def ToAttachments(in_dataset, field, ftype="", hyperlinkDir=""):
 
             # If working with a raster field
             elif type == "raster":
+                arcpy.SetProgressor("step", "Processing rasters in field {0}".format(field), 0, count, 1)
+                catalogPath = arcpy.Describe(in_dataset).catalogPath
                 with arcpy.da.SearchCursor(in_dataset, ["OID@"]) as scur:
-                    i = 1
-                    for row in scur:
-                        try:
-                            arcpy.SetProgressorLabel("Processing record {0}/{1}".format(i, count))
-                            inraster = r'{0}\{1}.OBJECTID = {2}'.format(arcpy.Describe(in_dataset).catalogPath, field, row[0])
-                            newname = os.path.join(str(filedir), "image_{0}.jpg".format(row[0]))
-                            arcpy.management.CopyRaster(inraster, newname)
-                            writer.writerow([str(row[0]), newname])
-                        except:
-                            arcpy.AddWarning("Cannot process raster field for OID {0}.".format(row[0]))
-                        finally:
-                            i+=1
+                    tasks = [(row[0],
+                              r'{0}\{1}.OBJECTID = {2}'.format(catalogPath, field, row[0]),
+                              os.path.join(str(filedir), "image_{0}".format(row[0])))
+                             for row in scur if row[0] not in done]
+                    arcpy.SetProgressorPosition(count - len(tasks))
+                    # The storage and format of a raster field are resolved once, not per row
+                    if tasks:
+                        extension = rasterExtension(tasks[0][1], ftype)
+                        tasks = [task + (extension,) for task in tasks]
+                    # Export the rasters in parallel, one CopyRaster per row
+                    exportRasters(tasks, writer, rasterWorkers)
                     f.close()
                     arcpy.management.EnableAttachments(in_dataset)
                     arcpy.management.AddAttachments(in_dataset, oidfield, matchtable, "OID", "FILE")
@@ -103,72 +974,52 @@ def ToAttachments(in_dataset, field, ftype="", hyperlinkDir=""):
                         break
                     # If the path 'exists', it is a file on disk or network location
                     if os.path.exists(path):
-                        arcpy.management.EnableAttachments(in_dataset)
-                        arcpy.management.AddAttachments(in_dataset, oidfield, in_dataset, oidfield, field)
-                        arcpy.AddWarning(arcpy.GetMessages(1))
-                        arcpy.SetProgressorPosition(count)
+                        # Check every path up front and attach only the files which exist
+                        rows = [(row[0], row[1]) for row in scur if row[0] not in done]
+                        arcpy.SetProgressorPosition(count - len(rows))
+                        attachPaths(in_dataset, oidfield, rows, f, writer, matchtable, workers)
                     # If the path doesn't exist, check if it is on the web or relative to the hyperlink base
                     else:
                         # On the web
                         if str(path).lower().find("http") > -1 or str(path).lower().find("www") > -1:
-                            for row in scur:
-                                path = row[1]
-                                try:
-                                    # Go through search cur, download file and write oid and new path
-                                    u = urlopen(path)
-                                    newname = os.path.join(str(filedir), os.path.basename(path))
-                                    localFile = open(newname, "wb")
-                                    localFile.write(u.read())
-                                    localFile.close()
-                                    writer.writerow([str(row[0]), newname])
-                                except:
-                                    arcpy.AddWarning("Cannot process file {0} for OID {1}".format(row[1], row[0]))
-                                finally:
-                                    arcpy.SetProgressorPosition()
-                            # Enable geodatabase attachments and write intermediate files to gdb
-                            f.close()
-                            arcpy.management.EnableAttachments(in_dataset)
-                            arcpy.management.AddAttachments(in_dataset, oidfield, matchtable, "OID", "FILE")
+                            # Go through search cur, download files and write oid and new path
+                            urls = [(row[0], row[1]) for row in scur if row[0] not in done]
+                            arcpy.SetProgressorPosition(count - len(urls))
+                            downloadToAttachments(in_dataset, oidfield, urls, str(filedir), f, writer, matchtable,
+                                                  direct, batchSize, workers, chunkSize, maxSize, cache, limiter, journal)
                         # Relative to hyperlink base?
                         else:
                             if hyperlinkDir:
                                 # If the hyperlinked path exists it is a file on disk or network location
                                 if os.path.exists(os.path.join(hyperlinkDir, path)):
-                                    arcpy.management.EnableAttachments(in_dataset)
-                                    arcpy.management.AddAttachments(in_dataset, oidfield, in_dataset, oidfield, field, hyperlinkDir)
-                                    arcpy.AddWarning(arcpy.GetMessages(1))
-                                    arcpy.SetProgressorPosition(count)
+                                    rows = [(row[0], os.path.join(hyperlinkDir, str(row[1]))) for row in scur if row[0] not in done]
+                                    arcpy.SetProgressorPosition(count - len(rows))
+                                    attachPaths(in_dataset, oidfield, rows, f, writer, matchtable, workers)
                                 # Else, the hyperlink path might be to web
                                 elif str(hyperlinkDir).lower().find("http") > -1 or str(hyperlinkDir).lower().find("www") > -1:
-                                    for row in scur:
-                                        path = str(hyperlinkDir) + "/" + str(row[1])
-                                        try:
-                                            # Go through search cur, download file and write oid and new path
-                                            u = urlopen(path)
-                                            newname = os.path.join(str(filedir), os.path.basename(path))
-                                            localFile = open(newname, "wb")
-                                            localFile.write(u.read())
-                                            localFile.close()
-                                            writer.writerow([str(row[0]), newname])
-                                        except:
-                                            arcpy.AddWarning("Cannot process file {0} for OID {1}".format(row[0], row[1]))
-                                        finally:
-                                            arcpy.SetProgressorPosition()
-                                    # Enable geodatabase attachments and write intermediate files to gdb
-                                    f.close()
-                                    arcpy.management.EnableAttachments(in_dataset)
-                                    arcpy.management.AddAttachments(in_dataset, oidfield, matchtable, "OID", "FILE")
+                                    # Go through search cur, download files and write oid and new path
+                                    urls = [(row[0], str(hyperlinkDir) + "/" + str(row[1])) for row in scur if row[0] not in done]
+                                    arcpy.SetProgressorPosition(count - len(urls))
+                                    downloadToAttachments(in_dataset, oidfield, urls, str(filedir), f, writer, matchtable,
+                                                          direct, batchSize, workers, chunkSize, maxSize, cache, limiter, journal)
                                 else:
                                     arcpy.AddWarning("The first record in field '{0}' does not contain a valid path. Processing will not continue.".format(field))
                             else:
                                 arcpy.AddWarning("The first record in field '{0}' does not contain a valid path. Processing will not continue.".format(field))
 
+        completed = True
     except:
         raise
     finally:
+        if cache is not None:
+            cache.save()
         if filedir:
-            # Delete the temporary folder
-            arcpy.management.Delete(filedir)
+            if resume and not completed:
+                # Keep the journal and downloaded files for the next run
+                arcpy.AddWarning("Progress was saved to {0}. Run the tool again with the same inputs to continue.".format(filedir))
+            else:
+                # Delete the temporary folder
+                arcpy.management.Delete(filedir)
 
 # Run the script
 if __name__ == '__main__':
@@ -180,7 +1031,16 @@ if __name__ == '__main__':
         hyperlinkDir = arcpy.mapping.MapDocument("current").hyperlinkBase
     except:
         hyperlinkDir = ""
+    workers = arcpy.GetParameter(4) if arcpy.GetArgumentCount() > 4 else None
+    resume = arcpy.GetParameter(5) if arcpy.GetArgumentCount() > 5 else False
+    rasterWorkers = arcpy.GetParameter(6) if arcpy.GetArgumentCount() > 6 else None
+    direct = arcpy.GetParameter(7) if arcpy.GetArgumentCount() > 7 else False
+    cacheDir = arcpy.GetParameterAsText(8) if arcpy.GetArgumentCount() > 8 else None
+    batchSize = arcpy.GetParameter(9) if arcpy.GetArgumentCount() > 9 else None
+    hostConnections = arcpy.GetParameter(10) if arcpy.GetArgumentCount() > 10 else None
 
-    ToAttachments(in_dataset, field, ftype, hyperlinkDir)
+    ToAttachments(in_dataset, field, ftype, hyperlinkDir, workers or DOWNLOAD_WORKERS, resume=resume,
+                  rasterWorkers=rasterWorkers, direct=direct, cacheDir=cacheDir,
+                  batchSize=batchSize or ATTACH_BATCH_SIZE, hostConnections=hostConnections or HOST_CONNECTIONS)
     arcpy.SetParameterAsText(3, in_dataset)
     print ("finished")
\ No newline at end of file
@@ -0,0 +1,346 @@
+'''
+Source Name: benchmark_ToAttachments.py
+Version: Python 2.7 / 3.4+ (ArcGIS is not required)
+
+Description:
+    Benchmarks ToAttachments.py without ArcGIS. A stand-in arcpy module serves a
+    synthetic table whose field holds BLOBs, rasters, file paths or hyperlinks,
+    and a local HTTP stand-in server serves the hyperlinked files with a
+    configurable size, latency and error rate. Each source type runs in its own
+    process and reports:
+
+        files/s    files attached per second
+        MB/s       attachment megabytes loaded per second
+        peak RSS   peak resident memory of the process (Linux / macOS only)
+
+    Raster exports run on a process pool which inherits the stand-in arcpy
+    module, so the raster source needs a platform which forks (Linux / macOS).
+
+    Runs are isolated and measured with runIsolated and peakRSS from
+    ../FeaturesToGPX/benchmark_FeaturesToGPX.py.
+
+Usage:
+    python benchmark_ToAttachments.py
+    python benchmark_ToAttachments.py --rows 20000 --file-size 1048576 --sources web
+    python benchmark_ToAttachments.py --sources web --latency 0.05 --error-rate 0.02 --direct
+    python benchmark_ToAttachments.py --check-resume --rows 100 --batch-size 30
+
+    --check-resume runs each source with resume on, failing the second
+    AddAttachments call, then resumes the run and checks that every record ended
+    up with exactly one attachment.
+'''
+
+import argparse
+import csv
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+from functools import partial
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# The process isolation and memory measurement shared with the FeaturesToGPX benchmark
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "FeaturesToGPX"))
+from benchmark_FeaturesToGPX import peakRSS, runIsolated
+
+SOURCES = ["blob", "raster", "path", "web"]
+FIELD_TYPES = {"blob": "Blob", "raster": "Raster", "path": "String", "web": "String"}
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    ''' Serves every path with a payload ending in the path, so files do not share
+    content, after a fixed latency, answering a fraction of the requests with 503 '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fileSize, latency, errorRate):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.payload = b"\xff" * fileSize
+        self.latency = latency
+        self.errorRate = errorRate
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            n = server.requests
+        if server.latency:
+            time.sleep(server.latency)
+        # Fail every k-th request, which spreads the errors evenly over the run
+        if server.errorRate and n % max(1, int(round(1 / server.errorRate))) == 0:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        tag = self.path.encode("utf-8")
+        body = server.payload[:-len(tag)] + tag
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def installFakeArcpy(source, rows, fileSize, workDir, baseURL):
+    ''' Put a stand-in arcpy module in sys.modules which serves a synthetic table
+    of one source type; returns the field name and a dict counting attached files.
+    Setting stats["failAt"] to n makes the n-th AddAttachments call fail '''
+
+    field = "ATTACH_SRC"
+    stats = {"files": 0, "bytes": 0, "oids": [], "calls": 0, "failAt": None}
+    payload = b"\xff" * fileSize
+
+    if source == "path":
+        # One file per 100 rows is enough to exercise the path checks and AddAttachments
+        pathDir = os.path.join(workDir, "paths")
+        os.mkdir(pathDir)
+        for n in range(min(rows, 100)):
+            with open(os.path.join(pathDir, "{0}.bin".format(n)), "wb") as f:
+                f.write(payload)
+
+    def value(oid):
+        if source == "blob":
+            # Distinct content per row so deduplication does not flatter the numbers
+            return memoryview(payload[:-8] + struct.pack("<q", oid) if fileSize > 8 else payload)
+        if source == "path":
+            return os.path.join(workDir, "paths", "{0}.bin".format(oid % 100))
+        if source == "web":
+            return "{0}/{1}.bin".format(baseURL, oid)
+        return None
+
+    class Namespace(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class Result(object):
+        def __init__(self, value):
+            self.value = value
+
+        def getOutput(self, index):
+            return self.value
+
+        def __str__(self):
+            return str(self.value)
+
+    class SearchCursor(object):
+        def __init__(self, dataset, fields, where=None, **kwargs):
+            self.dataset = dataset
+            self.fields = fields
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def reset(self):
+            pass
+
+        def __iter__(self):
+            if self.dataset.endswith("__ATTACH"):
+                return iter([(oid,) for oid in stats["oids"]])
+            return (tuple(oid if f == "OID@" else value(oid) for f in self.fields)
+                    for oid in range(1, rows + 1))
+
+    class InsertCursor(object):
+        def __init__(self, table, fields):
+            self.fields = fields
+
+        def insertRow(self, row):
+            stats["oids"].append(row[0])
+            stats["files"] += 1
+            stats["bytes"] += row[self.fields.index("DATA_SIZE")]
+
+    class Editor(object):
+        def __init__(self, workspace):
+            pass
+
+        def startEditing(self, *args):
+            pass
+
+        def startOperation(self):
+            pass
+
+        def stopOperation(self):
+            pass
+
+        def stopEditing(self, save):
+            pass
+
+    def addAttachments(dataset, oidField, matchTable, matchField, pathField, workingFolder=None):
+        stats["calls"] += 1
+        if stats["calls"] == stats["failAt"]:
+            raise RuntimeError("AddAttachments failed")
+        # Read every file back, as the real tool does when it loads the attachments
+        with open(matchTable) as f:
+            for row in csv.DictReader(f):
+                stats["oids"].append(int(row[matchField]))
+                with open(row[pathField], "rb") as attached:
+                    while attached.read(1024 * 1024):
+                        pass
+                stats["files"] += 1
+                stats["bytes"] += os.path.getsize(row[pathField])
+
+    def copyRaster(inRaster, outRaster):
+        with open(outRaster, "wb") as f:
+            f.write(payload)
+
+    def createFolder(folder, name):
+        path = os.path.join(workDir, name)
+        os.mkdir(path)
+        return Result(path)
+
+    def describe(dataset):
+        fields = [Namespace(name="OBJECTID", type="OID"),
+                  Namespace(name=field, type=FIELD_TYPES[source])]
+        return Namespace(fields=fields, OIDFieldName="OBJECTID", catalogPath=dataset,
+                                     path="", dataType="Workspace" if dataset == "" else "Table",
+                                     globalIDFieldName="")
+
+    def listFields(dataset):
+        if dataset.endswith("__ATTACH"):
+            return [Namespace(name=n) for n in ("REL_OBJECTID", "CONTENT_TYPE", "ATT_NAME", "DATA_SIZE", "DATA")]
+        return describe(dataset).fields
+
+    noop = lambda *args, **kwargs: None
+    arcpy = types.ModuleType("arcpy")
+    arcpy.env = Namespace(overwriteOutput=True, scratchFolder=workDir)
+    arcpy.ProductInfo = lambda: "ArcInfo"
+    arcpy.GetArgumentCount = lambda: 0
+    arcpy.GetMessages = lambda severity=0: ""
+    arcpy.AddWarning = arcpy.AddError = arcpy.AddMessage = noop
+    arcpy.SetProgressor = arcpy.SetProgressorLabel = arcpy.SetProgressorPosition = noop
+    arcpy.Exists = lambda dataset: dataset.endswith("__ATTACH") and bool(stats["oids"])
+    arcpy.Describe = describe
+    arcpy.ListFields = listFields
+    arcpy.da = Namespace(SearchCursor=SearchCursor, InsertCursor=InsertCursor, Editor=Editor)
+    arcpy.management = Namespace(
+        GetCount=lambda dataset: Result(str(rows)), CreateFolder=createFolder,
+        EnableAttachments=noop, AddAttachments=addAttachments, CopyRaster=copyRaster,
+        Delete=lambda path: shutil.rmtree(str(path), ignore_errors=True))
+    sys.modules["arcpy"] = arcpy
+    return field, stats
+
+
+def runSource(source, args, baseURL):
+    ''' Attach one source type and report its throughput; runs in a fresh process '''
+
+    workDir = tempfile.mkdtemp(prefix="attachbench_")
+    try:
+        field, stats = installFakeArcpy(source, args.rows, args.file_size, workDir, baseURL)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import ToAttachments
+        ToAttachments.BACKOFF_BASE = 0.05
+
+        start = time.time()
+        ToAttachments.ToAttachments("synthetic", field, "BIN", workers=args.workers,
+                                    rasterWorkers=args.raster_workers, direct=args.direct,
+                                    batchSize=args.batch_size or None,
+                                    hostConnections=args.host_connections)
+        elapsed = time.time() - start
+        return source, stats["files"], stats["bytes"], elapsed, peakRSS()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def checkResume(source, args, baseURL):
+    ''' Fail one source part way through a resumable run, resume it and count the
+    records which end up without an attachment or with more than one '''
+
+    workDir = tempfile.mkdtemp(prefix="attachbench_")
+    try:
+        field, stats = installFakeArcpy(source, args.rows, args.file_size, workDir, baseURL)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import ToAttachments
+
+        run = partial(ToAttachments.ToAttachments, "synthetic", field, "BIN", workers=args.workers,
+                      resume=True, rasterWorkers=args.raster_workers, direct=args.direct,
+                      batchSize=args.batch_size or None, hostConnections=args.host_connections)
+        stats["failAt"] = 2
+        try:
+            run()
+        except RuntimeError:
+            pass
+        stats["failAt"] = None
+        run()
+        counts = Counter(stats["oids"])
+        missing = [oid for oid in range(1, args.rows + 1) if oid not in counts]
+        repeated = [oid for oid, n in counts.items() if n > 1]
+        return source, len(counts), missing, repeated
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ToAttachments against a synthetic table and a local HTTP server.")
+    parser.add_argument("--rows", type=int, default=2000, help="rows in the synthetic table")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="bytes per file")
+    parser.add_argument("--sources", default=",".join(SOURCES), help="comma separated source types: " + ", ".join(SOURCES))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the HTTP stand-in waits before answering")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of HTTP requests answered with 503")
+    parser.add_argument("--workers", type=int, default=8, help="download / path check threads")
+    parser.add_argument("--raster-workers", type=int, default=None, help="raster export processes")
+    parser.add_argument("--host-connections", type=int, default=8, help="concurrent downloads per host")
+    parser.add_argument("--batch-size", type=int, default=500, help="attach batch size, 0 for a single AddAttachments")
+    parser.add_argument("--direct", action="store_true", help="insert BLOBs and downloads straight into the attachment table")
+    parser.add_argument("--check-resume", action="store_true", help="check that a failed, resumed run attaches every record once")
+    args = parser.parse_args()
+
+    server = StandInServer(args.file_size, args.latency, args.error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    baseURL = "http://127.0.0.1:{0}".format(server.server_address[1])
+
+    if args.check_resume:
+        failed = False
+        try:
+            for source in args.sources.split(","):
+                result = runIsolated(checkResume, source, args, baseURL)
+                if result is None:
+                    print("{0:<8} failed".format(source))
+                    failed = True
+                    continue
+                source, attached, missing, repeated = result
+                print("{0:<8} {1} records attached, {2} missing {3}, {4} attached twice {5}".format(
+                    source, attached, len(missing), missing[:10], len(repeated), repeated[:10]))
+                failed = failed or bool(missing or repeated)
+        finally:
+            server.shutdown()
+        sys.exit(1 if failed else 0)
+
+    print("{0:<8}{1:>10}{2:>12}{3:>10}{4:>10}{5:>14}".format("source", "files", "files/s", "MB/s", "seconds", "peak RSS MB"))
+    try:
+        for source in args.sources.split(","):
+            result = runIsolated(runSource, source, args, baseURL)
+            if result is None:
+                print("{0:<8} failed".format(source))
+                continue
+            source, files, size, elapsed, rss = result
+            print("{0:<8}{1:>10}{2:>12.1f}{3:>10.1f}{4:>10.2f}{5:>14}".format(
+                source, files, files / elapsed, size / 1048576.0 / elapsed, elapsed,
+                "n/a" if rss is None else "{0:.0f}".format(rss)))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,9 @@ import os
 
 stuff = []
 for f in glob.glob("*/*.py"):
+    # Benchmarks are for development and are not installed with the toolboxes
+    if os.path.basename(f).startswith("benchmark_"):
+        continue
     stuff.append((os.path.join("esri/toolboxes", os.path.dirname(f)),
                   [os.path.join(os.path.dirname(f),os.path.basename(f))] ))
 stuff.append( ('esri/toolboxes', ["SampleTools.tbx"]))
@@ -27,6 +30,7 @@ setup(name             = "sample-gp-tools",
       package_data     = {"": ["*/*.py",
                                "SampleTools.tbx",
                                ] },
+      exclude_package_data = {"": ["*/benchmark_*.py"]},
       data_files       = stuff,
       classifiers      = [
         "Development Status :: 5 - Production/Stable",